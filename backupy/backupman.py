@@ -21,9 +21,15 @@ import time
 import typing
 
 from .config import ConfigObject
+from .events import events
+from .latency import latency
+from .memprofile import memprofile
+from .metrics import metrics
 from .fileman import FileManager
 from .filescanner import FileScanner
 from .logman import LogManager
+from .ratelimiter import RateLimiter, setIoPriority
+from .statusbar import StatusBar
 from .transferlists import TransferLists
 from .utils import (
     FileOps,
@@ -63,9 +69,23 @@ class BackupManager():
             self.config.scan_only = True
         if "compare_mode" in args and args["compare_mode"] is not None and not gui:
             self.config.compare_mode = args["compare_mode"]
+        if "plan_apply" in args and args["plan_apply"]:
+            self.config.plan_apply = args["plan_apply"]
+        if "plan_export" in args and args["plan_export"]:
+            self.config.plan_export = args["plan_export"]
+        if "event_stream" in args and args["event_stream"]:
+            self.config.event_stream = args["event_stream"]
+        if "metrics_file" in args and args["metrics_file"]:
+            self.config.metrics_file = args["metrics_file"]
+        if "memprofile" in args and args["memprofile"]:
+            self.config.memprofile = args["memprofile"]
         # scan only mode
         if self.config.scan_only and (self.config.dest == "" or not FileOps.isdir(self.config.dest)):
             self.config.dest = self.config.source
+        # transfer plans are only checked with a quick stat, not compatible with modes that rely on a full scan
+        if self.config.plan_apply and (self.config.scan_only or self.config.use_cold_storage):
+            self.log.colourPrint(getString("A transfer plan can not be applied with --dbscan or --cold"), "R")
+            sys.exit(1)
         # cold storage mode
         if self.config.use_cold_storage:
             self.config.write_database_x2 = True
@@ -108,6 +128,33 @@ class BackupManager():
                          getString("Config:"), str(vars(self.config))])
         # lock config from future changes (makes code safer and easier to verify)
         self.config.locked = True
+        # status bar repaints per second
+        StatusBar.refresh_rate = self.config.stdout_status_bar_rate
+        # structured events and metrics for other programs, closed if a previous job in this process used them
+        if self.config.event_stream:
+            events.open(self.config.event_stream, self.config.event_progress_ms)
+        else:
+            events.close()
+        if self.config.metrics_file:
+            metrics.open(self.config.metrics_file)
+        else:
+            metrics.close()
+        if self.config.latency_report > 0:
+            latency.open(self.config.latency_report)
+        else:
+            latency.close()
+        # tracemalloc is only started with --memprofile
+        if self.config.memprofile:
+            memprofile.open(self.config.memprofile)
+        else:
+            memprofile.close()
+        # io priority and bandwidth limits (limits can be reloaded from io_limits_file with SIGHUP)
+        if not setIoPriority(self.config.io_priority):
+            self.log.colourPrint(getString("Unable to set IO priority: %s") % (self.config.io_priority), "Y")
+        # the limiter is only installed into FileOps while run() is active
+        self.rate_limiter = None
+        if self.config.limit_read_bps or self.config.limit_write_bps or self.config.limit_iops or self.config.io_limits_file:
+            self.rate_limiter = RateLimiter(self.config.limit_read_bps, self.config.limit_write_bps, self.config.limit_iops, self.config.io_limits_file)
 
     def _saveConfig(self) -> None:
         """Saves config as JSON file"""
@@ -128,16 +175,71 @@ class BackupManager():
             self.log.colourPrint(getString("A config file matching the specified source was not found (case sensitive)"), "R")
             sys.exit(1)
 
-    def _abortRun(self) -> int:
+    def _abortRun(self, transfer_lists: typing.Union[TransferLists, None] = None) -> int:
         """Write log for aborted run and return 1 (internal use only)"""
         self.log.append([getString("### ABORTED ###")])
         self.log.writeLog("database.aborted.json")
         self.log.colourPrint(getString("Run aborted"), "Y")
+        self._reportRun("aborted", transfer_lists)
         return 1
 
+    def _phaseStart(self, phase: str) -> None:
+        events.phaseStart(phase)
+        metrics.phaseStart(phase)
+
+    def _phaseEnd(self, phase: str, transfer_lists: typing.Union[TransferLists, None] = None) -> None:
+        events.phaseEnd(phase)
+        metrics.phaseEnd(phase)
+        if memprofile.enabled:
+            memprofile.snapshot(phase, self._getStructures(transfer_lists))
+
+    def _getStructures(self, transfer_lists: typing.Union[TransferLists, None]) -> dict:
+        """the main data structures of the run by name, for memory profiling"""
+        structures = {"log._log": self.log._log, "log._log_columns": self.log._log_columns}
+        sides = [("source", getattr(self, "source", None)), ("dest", getattr(self, "dest", None))]
+        for side_name, side in sides:
+            if side is None or (side_name == "dest" and side is self.source):
+                continue
+            for name in ["dict_prev", "dict_current", "set_unmodified", "set_modified", "set_missing", "set_new", "set_crc_errors", "set_dirs"]:
+                structures["%s.%s" % (side_name, name)] = getattr(side, name)
+        if transfer_lists is not None:
+            names = ["source_only", "dest_only", "changed", "moved", "source_deleted", "dest_deleted"]
+            for name, files in zip(names, transfer_lists.getLists()):
+                structures["transfer_lists.%s" % (name)] = files
+        return structures
+
+    def _reportRun(self, status: str, transfer_lists: typing.Union[TransferLists, None]) -> None:
+        """emit the final event, write metrics and the memory profile with the number of files and bytes in each transfer list, then close them"""
+        if memprofile.enabled:
+            memprofile.snapshot("end", self._getStructures(transfer_lists))
+            memprofile.write()
+            self.log.colourPrint(getString("Memory profile saved to:\n%s") % (self.config.memprofile), "G")
+        if not (events.enabled or metrics.enabled):
+            return None
+        categories = {}
+        if transfer_lists is not None:
+            source_dict, _ = self.source.getDicts()
+            dest_dict, _ = self.dest.getDicts()
+            source_only, dest_only, changed, moved, source_deleted, dest_deleted = transfer_lists.getLists()
+            for category, files, file_dict in [("source_only", source_only, source_dict),
+                                               ("dest_only", dest_only, dest_dict),
+                                               ("changed", changed, source_dict),
+                                               ("moved", [f["source"] for f in moved], source_dict),
+                                               ("source_deleted", source_deleted, dest_dict),
+                                               ("dest_deleted", dest_deleted, source_dict)]:
+                categories[category] = {"count": len(files),
+                                        "bytes": sum(file_dict[f]["size"] for f in files if f in file_dict and "size" in file_dict[f])}
+        events.summary(status, categories)
+        events.close()
+        for category in categories:
+            metrics.set("backupy_transfer_files", categories[category]["count"], category=category)
+            metrics.set("backupy_transfer_bytes", categories[category]["bytes"], category=category)
+        metrics.write(status, {"source": self.config.source, "dest": self.config.dest})
+        metrics.close()
+
     def _internalTests(self, transfer_lists: TransferLists) -> None:
         """redundant checks (slow), used only for internal testing when checking test cases"""
-        if self.backup_time == "000000-0000":
+        if self.backup_time == "000000-0000" and not self.config.plan_apply:
             testConsistency(self.source.getDicts(), self.source.getSets(),
                             self.dest.getDicts(), self.dest.getSets(),
                             transfer_lists.getSets(),
@@ -188,6 +290,47 @@ class BackupManager():
             transfer_lists.freeze()
         return transfer_lists
 
+    def _getPlanSettings(self) -> dict:
+        """settings that the contents of a transfer plan depend on, these must match when applying it"""
+        return {"source": self.config.source,
+                "dest": self.config.dest,
+                "main_mode": self.config.main_mode,
+                "select_mode": self.config.select_mode,
+                "force_posix_path_sep": self.config.force_posix_path_sep,
+                "sync_propagate_deletions": self.config.sync_propagate_deletions}
+
+    def _loadPlan(self) -> typing.Union[TransferLists, None]:
+        """load transfer lists from a plan, checking only the files in it instead of scanning and comparing directories"""
+        self.log.colourPrint(getString("Checking files in transfer plan:\n%s") % (self.config.plan_apply), "B")
+        plan = readJson(self.config.plan_apply)
+        self.source = FileScanner(self.config.source, self.config.source_unique_id,
+                                  self.config.dest, self.config, self.gui)
+        self.dest = FileScanner(self.config.dest, self.config.dest_unique_id,
+                                self.config.source, self.config, self.gui)
+        self.source.loadDatabase()
+        self.dest.loadDatabase()
+        self.log.source, self.log.dest = self.source, self.dest
+        if not plan or plan["settings"] != self._getPlanSettings():
+            self.log.colourPrint(getString("Transfer plan is empty or was created with different settings"), "R")
+            return None
+        lists = plan["lists"]
+        source_targets = lists["dest_only"] + [f["dest"] for f in lists["moved"] if f["match"] == "dest"]
+        dest_targets = lists["source_only"] + [f["source"] for f in lists["moved"] if f["match"] == "source"]
+        stale = self.source.loadPlanEntries(plan["source_files"], source_targets)
+        stale += self.dest.loadPlanEntries(plan["dest_files"], dest_targets)
+        if stale:
+            self.log.colourPrint(getString("Files changed since the transfer plan was created: %s") % (len(stale)), "R")
+            self.log.append([getString("### CHANGED SINCE PLAN ###")], ["Section"])
+            for f in stale:
+                self.log.append(["File:", "Plan", f], ["Header", "Subheader", "Path"])
+                if self.config.verbose:
+                    print(f)
+            return None
+        transfer_lists = TransferLists({"self_only": [], "other_only": [], "changed": [], "moved": []})
+        transfer_lists.importPlan(plan)
+        transfer_lists.freeze()
+        return transfer_lists
+
     def _databaseAndCorruptionCheck(self, dest_database_load_success: bool) -> bool:
         # get databases
         source_dict, source_prev = self.source.getDicts()
@@ -209,6 +352,9 @@ class BackupManager():
                     self.log.colourPrint(getString("WARNING: found files modified in both source and destination since last scan"), "Y")
                     detection_flag = True
                 self.log.colourPrint(getString("Sync Database Conflicts: %s") % (len(sync_conflicts)), "V")
+                for f in sync_conflicts:
+                    events.emit("conflict", kind="sync", path=f)
+                metrics.set("backupy_conflicts", len(sync_conflicts), kind="sync")
                 self.log.printSyncDbConflicts(sync_conflicts, source_dict, dest_dict, source_prev, dest_prev)
             else:
                 dest_conflicts = sorted(list(dest_modified))
@@ -218,6 +364,12 @@ class BackupManager():
                     self.log.colourPrint(getString("WARNING: found files modified in the destination since last scan"), "Y")
                     detection_flag = True
                 self.log.colourPrint(getString("Destination Database Conflicts: %s") % (len(dest_conflicts)), "V")
+                if events.enabled:
+                    for kind, files in [("dest_modified", dest_modified), ("dest_missing", dest_missing), ("dest_new", dest_new)]:
+                        for f in sorted(list(files)):
+                            events.emit("conflict", kind=kind, path=f)
+                for kind, files in [("dest_modified", dest_modified), ("dest_missing", dest_missing), ("dest_new", dest_new)]:
+                    metrics.set("backupy_conflicts", len(files), kind=kind)
                 self.log.printChangedFiles(dest_conflicts, dest_dict, dest_prev, "   Dest", "     DB")
         # print database conflicts concerning CRCs if available, as well as CRC conflicts between source and dest if attributes otherwise match
         crc_errors_detected = []
@@ -227,10 +379,13 @@ class BackupManager():
             detection_flag = True
             crc_errors_detected = sorted(list(source_crc_errors | dest_crc_errors))
             self.log.colourPrint(getString("CRC Errors Detected: %s") % (len(crc_errors_detected)), "V")
+            for f in crc_errors_detected:
+                events.emit("conflict", kind="crc_error", path=f)
             if self.config.source != self.config.dest:
                 self.log.printSyncDbConflicts(crc_errors_detected, source_dict, dest_dict, source_prev, dest_prev)
             else:
                 self.log.printChangedFiles(crc_errors_detected, source_dict, source_prev, " Source", "     DB")
+        metrics.set("backupy_conflicts", len(crc_errors_detected), kind="crc_error")
         # show curses tree
         if detection_flag:
             while not self.config.noprompt:
@@ -372,22 +527,64 @@ class BackupManager():
             fileman.copyFiles(self.config.dest, self.config.source, dest_only, dest_only)
             fileman.handleMovedFiles(moved)
             fileman.handleChangedFiles(self.config.source, self.config.dest, source_dict, dest_dict, changed)
+        # wait for archived and trashed files to be compressed
+        fileman.finishCompression()
+        # flush any files written since the last durability checkpoint
+        fileman.syncCheckpoint()
+        # point in time snapshot of the destination after all changes are made
+        if self.config.use_snapshots:
+            fileman.createSnapshot(self.config.dest, dest_dict)
+        # remove stored objects that are no longer referenced
+        if self.config.use_dedup_store:
+            fileman.pruneObjects(self.config.dest)
+            if self.config.main_mode == "sync" or self.config.select_mode != "source":
+                fileman.pruneObjects(self.config.source)
+        # remove partial copies of files that were removed or changed before they could be resumed
+        fileman.clearPartials(self.config.dest)
+        if self.config.source != self.config.dest:
+            fileman.clearPartials(self.config.source)
+        # remove directories left empty by the file operations
+        fileman.cleanupEmptyDirs()
 
     def run(self) -> int:
         """Main method, use this to run your job"""
+        if self.rate_limiter is None:
+            return self._run()
+        self.rate_limiter.install()
+        if self.config.io_limits_file and os.path.exists(self.config.io_limits_file):
+            self.rate_limiter.reload()
+        try:
+            return self._run()
+        finally:
+            # FileOps is shared by the process, so a later job (e.g. in a batch script) must not inherit these limits
+            self.rate_limiter.uninstall()
+
+    def _run(self) -> int:
         # dry run confirmation message
         if self.config.dry_run:
             simulation_msg = getString(" dry run")
             self.log.colourPrint(getString("Dry Run"), "V")
         else:
             simulation_msg = ""
-        # scan and compare directories
-        dest_database_load_success = self._scanDirectories()
-        transfer_lists = self._compareDirectories()
+        # scan and compare directories, or load what to transfer from a plan
+        if self.config.plan_apply:
+            dest_database_load_success = False
+            self._phaseStart("plan")
+            transfer_lists = self._loadPlan()
+            self._phaseEnd("plan", transfer_lists)
+            if transfer_lists is None:
+                return self._abortRun()
+        else:
+            self._phaseStart("scan")
+            dest_database_load_success = self._scanDirectories()
+            self._phaseEnd("scan")
+            self._phaseStart("compare")
+            transfer_lists = self._compareDirectories()
+            self._phaseEnd("compare", transfer_lists)
         # check for database conflicts or corruption
         detected_database_conflicts_or_corruption = self._databaseAndCorruptionCheck(dest_database_load_success)
         if self.config.quit_on_db_conflict and detected_database_conflicts_or_corruption:
-            return self._abortRun()
+            return self._abortRun(transfer_lists)
         # print differences between current and previous scans then exit if only scanning
         if self.config.scan_only:
             self._printAndLogScanOnlyDiffSummary("Source", self.source)
@@ -396,6 +593,7 @@ class BackupManager():
             self.log.append([getString("### SCAN COMPLETED ###")])
             self.log.writeLog("database.json")
             self.log.colourPrint(getString("Completed!"), "G")
+            self._reportRun("scan_only", None)
             return 0
         assert isinstance(transfer_lists, TransferLists)
         # print differences between source and dest
@@ -407,6 +605,7 @@ class BackupManager():
             self.log.colourPrint(getString("Directories already match, completed!"), "G")
             self.log.append([getString("### NO CHANGES FOUND ###")])
             self.log.writeLog("database.json")
+            self._reportRun("no_changes", transfer_lists)
             return 0
         # wait for go ahead
         self.log.writeLog("database.tmp.json")
@@ -418,7 +617,7 @@ class BackupManager():
                 go = simplePrompt(["y", "n", "skip", "curses"])
             if go == "skip":
                 if not transfer_lists.skipFileTransfers(self.log):
-                    return self._abortRun()
+                    return self._abortRun(transfer_lists)
             elif go == "curses":
                 try:
                     from .treedisplay import transfer_lists_tree
@@ -426,12 +625,19 @@ class BackupManager():
                 except Exception:
                     self.log.colourPrint(getString("Curses Error"), "R")
             elif go == "n":
-                return self._abortRun()
+                return self._abortRun(transfer_lists)
             elif go == "y":
                 break
+        # save transfer lists to apply later with --apply-plan
+        if self.config.plan_export:
+            transfer_lists.exportPlan(FileOps.abspath(self.config.plan_export), self.source, self.dest, self._getPlanSettings())
+            self.log.colourPrint(getString("Transfer plan saved to:\n%s") % (self.config.plan_export), "G")
         # backup operations
+        self._phaseStart("transfer")
         self._performBackup(transfer_lists, simulation_msg)
+        self._phaseEnd("transfer", transfer_lists)
         self.log.append([getString("### COMPLETED ###")])
         self.log.writeLog("database.json")
         self.log.colourPrint(getString("Completed!"), "G")
+        self._reportRun("completed", transfer_lists)
         return 0
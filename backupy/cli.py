@@ -14,10 +14,12 @@
 # https://github.com/elesiuta/backupy
 
 import argparse
+import os
 import sys
 import textwrap
 
 from .backupman import BackupManager
+from .history import printHistory
 from .utils import getString, getVersion
 
 
@@ -31,8 +33,25 @@ class ArgparseCustomFormatter(argparse.HelpFormatter):
         return argparse.HelpFormatter._split_lines(self, text, width)
 
 
+def historyMain(argv: list) -> int:
+    """look up the logged history of a path with backupy --history <path>"""
+    parser = argparse.ArgumentParser(prog="backupy --history",
+                                     description=getString("Show every logged change of a file and where its old versions were archived or trashed"))
+    parser.add_argument("path", action="store", type=str,
+                        help=getString("Path to the file (may no longer exist), or relative to --source"))
+    parser.add_argument("--source", dest="source", action="store", type=str, default="", metavar="dir",
+                        help=getString("Source containing the logs (found from path by default)"))
+    parser.add_argument("--config-dir", dest="config_dir", action="store", type=str, default="", metavar="dir",
+                        help=getString("config_dir of the source if it is not the default (the rest of its config is loaded from there)"))
+    args = parser.parse_args(argv)
+    return printHistory(args.path, args.source, args.config_dir)
+
+
 def main() -> int:
     """start the command line interface for backupy"""
+    # history without dashes is kept as a shorthand unless it is the name of a source directory
+    if sys.argv[1:2] == ["--history"] or (sys.argv[1:2] == ["history"] and not os.path.isdir("history")):
+        return historyMain(sys.argv[2:])
     parser = argparse.ArgumentParser(epilog=textwrap.dedent("""
                                      BackuPy is a simple backup program in python with an emphasis on data 
                                      integrity and transparent behaviour - https://github.com/elesiuta/backupy 
@@ -45,6 +64,7 @@ def main() -> int:
                                      usage="backupy [options] -- <source> <dest>\n"
                                            "       backupy <source> <dest> [options]\n"
                                            "       backupy <source> --load [-c mode] [--dbscan] [--dry-run]\n"
+                                           "       backupy --history <path> [--source dir] [--config-dir dir]\n"
                                            "       backupy -h | --help | --version")
     parser.add_argument("source", action="store", type=str,
                         help=getString("Path to source"))
@@ -111,6 +131,16 @@ def main() -> int:
                         help=getString("Only scan files to check and update their database entries"))
     group3.add_argument("-n", "--dry-run", dest="dry_run", action="store_true",
                         help=getString("Perform a dry run with no changes made to your files"))
+    group3.add_argument("--export-plan", dest="plan_export", action="store", type=str, default=None, metavar="path",
+                        help=getString("Save the files to transfer and their attributes to a plan (use with --dry-run to review it first)"))
+    group3.add_argument("--apply-plan", dest="plan_apply", action="store", type=str, default=None, metavar="path",
+                        help=getString("Transfer the files in a plan without scanning, after checking they have not changed since it was saved"))
+    group3.add_argument("--events", dest="event_stream", action="store", type=str, default=None, metavar="path",
+                        help=getString("Write JSON lines events (phases, file operations, conflicts, progress, summary) to a path or fd:N"))
+    group3.add_argument("--metrics", dest="metrics_file", action="store", type=str, default=None, metavar="path",
+                        help=getString("Write metrics of the run to a file in the Prometheus text format (for the node_exporter textfile collector)"))
+    group3.add_argument("--memprofile", dest="memprofile", action="store", type=str, default=None, metavar="path",
+                        help=getString("Trace memory allocations and write the top allocation sites and size of each data structure after each phase to a report"))
     group3.add_argument("-q", "--qconflicts", dest="quit_on_db_conflict", action="store_true",
                         help=getString(
                              "F!\n"
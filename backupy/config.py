@@ -36,6 +36,11 @@ class ConfigObject:
         self.nolog: bool = False
         self.nomoves: bool = False
         self.noprompt: bool = False
+        self.plan_apply: str = ""
+        self.plan_export: str = ""
+        self.event_stream: str = ""
+        self.metrics_file: str = ""
+        self.memprofile: str = ""
         self.dry_run: bool = False
         self.force_posix_path_sep: bool = False
         self.quit_on_db_conflict: bool = False
@@ -47,16 +52,45 @@ class ConfigObject:
         self.source_unique_id: str = "%05x" % random.randrange(16**5)
         self.dest_unique_id: str = "%05x" % random.randrange(16**5)
         self.archive_dir: str = ".backupy/Archive"
+        self.archive_compression: str = ""
+        self.log_compression: str = ""
         self.config_dir: str = ".backupy"
+        self.dedup_dir: str = ".backupy/Objects"
         self.log_dir: str = ".backupy/Logs"
+        self.snapshot_dir: str = ".backupy/Snapshots"
         self.trash_dir: str = ".backupy/Trash"
+        self.copy_order: str = ""
+        self.layout_order: str = ""
+        self.io_limits_file: str = ""
+        self.io_priority: str = ""
+        self.atomic_copy: bool = False
         self.cleanup_empty_dirs: bool = True
+        self.history_index: bool = False
         self.root_alias_log: bool = True
+        self.resume_copy_verify: bool = True
         self.stdout_status_bar: bool = True
+        self.use_dedup_store: bool = False
+        self.use_snapshots: bool = False
         self.verbose: bool = True
         self.write_database_x2: bool = False
         self.write_log_dest: bool = False
         self.write_log_summary: bool = False
+        self.delta_block_size: int = 4194304
+        self.delta_copy_threshold: int = 0
+        self.compression_workers: int = 2
+        self.journal_checkpoint_ops: int = 0
+        self.metadata_workers: int = 1
+        self.event_progress_ms: int = 1000
+        self.log_retention_days: int = 0
+        self.latency_report: int = 0
+        self.limit_iops: int = 0
+        self.limit_read_bps: int = 0
+        self.limit_write_bps: int = 0
+        self.resume_checkpoint_bytes: int = 67108864
+        self.resume_copy_threshold: int = 0
+        self.sync_every_bytes: int = 0
+        self.sync_every_files: int = 0
+        self.stdout_status_bar_rate: int = 10
         # load config
         for key in config:
             if config[key] is not None and hasattr(self, key):
@@ -66,13 +100,20 @@ class ConfigObject:
         # normalize paths (these should be relative, not absolute!)
         self.archive_dir = os.path.normpath(self.archive_dir)
         self.config_dir = os.path.normpath(self.config_dir)
+        self.dedup_dir = os.path.normpath(self.dedup_dir)
         self.log_dir = os.path.normpath(self.log_dir)
+        self.snapshot_dir = os.path.normpath(self.snapshot_dir)
         self.trash_dir = os.path.normpath(self.trash_dir)
         # check modes are valid
         self.main_mode, self.select_mode, self.compare_mode = self.main_mode.lower(), self.select_mode.lower(), self.compare_mode.lower()
         assert self.main_mode in ["mirror", "backup", "sync"]
         assert self.select_mode in ["source", "dest", "new", "no"]
         assert self.compare_mode in ["attr", "attr+", "crc"]
+        assert self.archive_compression in ["", "gzip", "bz2", "xz"]
+        assert self.log_compression in ["", "gzip", "bz2", "xz"]
+        assert self.copy_order in ["", "smallest", "largest", "interleave"]
+        assert self.layout_order in ["", "inode", "extent"]
+        assert self.io_priority in ["", "idle", "best-effort"]
 
     def __setattr__(self, name, value):
         if not hasattr(self, "locked"):
@@ -0,0 +1,95 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# https://github.com/elesiuta/backupy
+
+import json
+import os
+import threading
+import time
+
+
+class EventStream:
+    def __init__(self):
+        """Machine readable JSON lines events (phases, file operations, conflicts, progress, and a summary), nothing is emitted until open is given a target"""
+        self.enabled = False
+        self.file = None
+        self.lock = threading.Lock()
+        self.progress_interval = 1.0
+        self.last_progress = {}
+        self.phase_start = {}
+        self.op_counts = {}
+
+    def open(self, target: str, progress_ms: int) -> None:
+        """Write events to target, either a path (appended to) or fd:N for an open file descriptor"""
+        self.close()
+        if target.startswith("fd:"):
+            self.file = os.fdopen(int(target[3:]), "w", encoding="utf-8", closefd=False)
+        else:
+            self.file = open(target, "a", encoding="utf-8")
+        self.progress_interval = progress_ms / 1000
+        self.last_progress, self.phase_start, self.op_counts = {}, {}, {}
+        self.enabled = True
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+        self.enabled = False
+
+    def emit(self, event: str, **fields) -> None:
+        if not self.enabled:
+            return None
+        record = {"event": event, "time": round(time.time(), 3)}
+        record.update(fields)
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+    def phaseStart(self, phase: str) -> None:
+        if self.enabled:
+            self.phase_start[phase] = time.monotonic()
+            self.emit("phase_start", phase=phase)
+
+    def phaseEnd(self, phase: str) -> None:
+        if self.enabled:
+            duration = time.monotonic() - self.phase_start.pop(phase, time.monotonic())
+            self.emit("phase_end", phase=phase, duration=round(duration, 3))
+
+    def operation(self, op: str, source: str, dest: str, start: float, error: str = None, size: int = None, end: float = None) -> None:
+        """Result of a file operation started at start and finished at end (time.monotonic, now if not given), with its size in bytes if it succeeded"""
+        if not self.enabled:
+            return None
+        counts = self.op_counts.setdefault(op, {"ok": 0, "error": 0, "bytes": 0})
+        counts["ok" if error is None else "error"] += 1
+        counts["bytes"] += size or 0
+        self.emit("operation", op=op, source=source, dest=dest, bytes=size,
+                  duration=round((time.monotonic() if end is None else end) - start, 6), ok=error is None, error=error)
+
+    def progress(self, title: str, done: int, total: int, bytes_done: int = 0, total_bytes: int = 0, force: bool = False) -> None:
+        """Progress of title, sent at most once per progress interval unless forced"""
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        if not force and now - self.last_progress.get(title, 0) < self.progress_interval:
+            return None
+        self.last_progress[title] = now
+        self.emit("progress", title=title, done=done, total=total, bytes_done=bytes_done, total_bytes=total_bytes)
+
+    def summary(self, status: str, categories: dict) -> None:
+        """Final event of a run, with the counts and bytes of each transfer category and the results of file operations"""
+        self.emit("summary", status=status, categories=categories, operations=self.op_counts)
+
+
+# module level so StatusBar can send progress without a reference to the run, the target is opened from event_stream at the start of each run and closed after the summary
+events = EventStream()
@@ -13,14 +13,28 @@
 
 # https://github.com/elesiuta/backupy
 
+import concurrent.futures
+import contextlib
+import errno
+import heapq
+import itertools
 import os
+import re
 import subprocess
+import tempfile
+import threading
+import time
+import typing
+import zlib
 
 from .config import ConfigObject
+from .events import events
+from .latency import latency
+from .metrics import metrics
 from .filescanner import FileScanner
 from .logman import LogManager
 from .statusbar import StatusBar
-from .utils import FileOps, getString
+from .utils import FileOps, getLayoutKey, getString, readJson, writeJson
 
 
 class FileManager:
@@ -33,13 +47,36 @@ class FileManager:
         self.config = config
         self.source = source
         self.dest = dest
+        # compression of archived and trashed files, started by finishCompression with at most two queued jobs per worker
+        workers = max(1, self.config.compression_workers)
+        self.compression_pool = None
+        if self.config.archive_compression and not self.config.dry_run:
+            self.compression_pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.compression_slots = threading.BoundedSemaphore(workers * 2)
+        self.compression_jobs = []
+        # parent directories of removed or moved files, pruned once by cleanupEmptyDirs if they become empty
+        self.cleanup_dirs = {}
+        # files written since the last durability checkpoint
+        self.sync_roots = set()
+        self.sync_files = []
+        self.sync_bytes = 0
+        # directories known to exist (created by planDirs or already checked), directories are only removed at the end of the run
+        self.planned_dirs = set()
+        # archive and trash paths given out this run by _getArchiveName
+        self.archive_paths = set()
+        # disabled for the rest of the run if the destination does not support hardlinks
+        self.use_dedup_store = self.config.use_dedup_store
         # update file operation functions from config
         if self.config.nofollow:
             FileOps.copy = FileOps.copyff
         # use other backend
         if self.config.use_rsync:
+            self.rsync_args = ["rsync", "--archive"]
+            if self.config.limit_write_bps:
+                self.rsync_args.append("--bwlimit=%sK" % max(1, self.config.limit_write_bps // 1024))
+
             def rsync_proc(source, dest):
-                proc = subprocess.run(["rsync", "--archive", source, dest], capture_output=True, universal_newlines=True)
+                proc = subprocess.run(self.rsync_args + [source, dest], capture_output=True, universal_newlines=True)
                 if proc.stderr or proc.returncode:
                     raise Exception("rsync error: " + " ".join(proc.stderr.splitlines()) + " return code " + str(proc.returncode))
             FileOps.copy = rsync_proc
@@ -48,44 +85,67 @@ class FileManager:
     # Basic file operation methods (only these methods touch files directly) #
     ##########################################################################
 
-    def _removeFile(self, root_path: str, file_relative_path: str) -> None:
+    def _removePath(self, root_path: str, file_relative_path: str) -> str:
+        # filesystem part of _removeFile (may run on a metadata worker), returns the path removed
+        path = os.path.join(root_path, file_relative_path)
+        if FileOps.isdir(path):
+            try:
+                FileOps.rmdir(path)
+            except IOError:
+                FileOps.chmod(path, 0o777)
+                FileOps.rmdir(path)
+        else:
+            if self.config.forbidden_extensions_list:
+                if os.path.exists(path + "~"):
+                    #restore
+                    file_name, file_extension = os.path.splitext(path)
+                    if file_extension in self.config.forbidden_extensions_list:
+                        path += "~"
+                elif os.path.exists(path):
+                    #backup
+                    file_name, file_extension = os.path.splitext(path)
+                    if file_extension in self.config.forbidden_extensions_list:
+                        path += "~"
+            try:
+                FileOps.remove(path)
+            except IOError:
+                FileOps.chmod(path, 0o777)
+                FileOps.remove(path)
+        return path
+
+    def _recordOp(self, op: str, source: str, dest: typing.Union[str, None], start: float, error: typing.Union[str, None] = None, size: typing.Union[int, None] = None, end: typing.Union[float, None] = None) -> None:
+        """Report a file operation started at start and finished at end (time.monotonic, now if not given) to the event stream, metrics, and latency tracker, size is of dest if not given"""
+        if end is None:
+            end = time.monotonic()
+        if latency.enabled:
+            latency.record(op, source, end - start)
+        if not (events.enabled or metrics.enabled):
+            return None
+        if size is None and error is None and dest is not None and os.path.lexists(dest):
+            size = os.lstat(dest).st_size
+        events.operation(op, source, dest, start, error, size, end)
+        metrics.operation(op, size, error)
+
+    def _removeFile(self, root_path: str, file_relative_path: str, result: typing.Union[concurrent.futures.Future, None] = None) -> None:
+        start = time.monotonic()
         try:
             self.log.append(["Remove:", root_path, file_relative_path])
             if not self.config.dry_run:
-                path = os.path.join(root_path, file_relative_path)
-                if FileOps.isdir(path):
-                    try:
-                        FileOps.rmdir(path)
-                    except IOError:
-                        FileOps.chmod(path, 0o777)
-                        FileOps.rmdir(path)
-                else:
-                    if self.config.forbidden_extensions_list:
-                        if os.path.exists(path + "~"):
-                            #restore
-                            file_name, file_extension = os.path.splitext(path)
-                            if file_extension in self.config.forbidden_extensions_list:
-                                path += "~"
-                        elif os.path.exists(path):
-                            #backup
-                            file_name, file_extension = os.path.splitext(path)
-                            if file_extension in self.config.forbidden_extensions_list:
-                                path += "~"
-                    try:
-                        FileOps.remove(path)
-                    except IOError:
-                        FileOps.chmod(path, 0o777)
-                        FileOps.remove(path)
+                # result is from _startMetadataOps if the removal was already started
+                path = result.result() if result is not None else self._removePath(root_path, file_relative_path)
+                self.planned_dirs.discard(path)
                 if self.config.cleanup_empty_dirs:
-                    head = os.path.dirname(path)
-                    if len(FileOps.listdir(head)) == 0:
-                        FileOps.removedirs(head)
+                    self.cleanup_dirs[os.path.dirname(path)] = root_path
+            size = (self.source if root_path == self.config.source else self.dest).dict_current.get(file_relative_path, {}).get("size")
             self.source.updateDictOnRemove(root_path, file_relative_path, self.dest)
+            self._recordOp("remove", os.path.join(root_path, file_relative_path), None, start, size=size)
         except Exception as e:
             self.log.append(["REMOVE ERROR", root_path, file_relative_path, str(e)])
+            self._recordOp("remove", os.path.join(root_path, file_relative_path), None, start, str(e))
             print(e)
 
     def _copyFile(self, source_root: str, dest_root: str, source_file: str, dest_file: str) -> None:
+        start = time.monotonic()
         try:
             self.log.append(["Copy:", source_root, source_file, dest_root, dest_file])
             if not self.config.dry_run:
@@ -107,38 +167,464 @@ class FileManager:
                     if FileOps.islink(source):
                         FileOps.copyff(source, dest)
                     else:
-                        FileOps.makedirs(dest)
+                        # dest may already exist (e.g. mirroring an empty dir over one whose contents are being removed)
+                        FileOps.makedirs(dest, exist_ok=True)
+                    # a copied dir is wanted even if empty, so it must not be pruned by cleanupEmptyDirs
+                    self.cleanup_dirs.pop(dest, None)
                 else:
-                    if not FileOps.isdir(os.path.dirname(dest)):
-                        FileOps.makedirs(os.path.dirname(dest))
-                    try:
-                        FileOps.copy(source, dest)
-                    except IOError:
-                        FileOps.chmod(dest, 0o777)
-                        FileOps.copy(source, dest)
+                    self._makeParentDir(dest)
+                    if self.use_dedup_store and not FileOps.islink(source):
+                        self._copyObject(source_root, dest_root, source_file, source, dest)
+                    elif (self.config.resume_copy_threshold > 0 and not self.config.use_rsync and
+                          not FileOps.islink(source) and FileOps.stat(source).st_size >= self.config.resume_copy_threshold):
+                        # large files are copied to a temp file in config_dir that can be resumed if interrupted, then renamed into place
+                        part_path = self._getPartialPath(dest_root, dest, ".part")
+                        FileOps.resume(source, dest, part_path, self.config.resume_checkpoint_bytes, self.config.resume_copy_verify)
+                    elif self.config.atomic_copy:
+                        # copy to a temp name in config_dir (never scanned) then rename into place so an interrupted copy never leaves a truncated file
+                        temp = self._getPartialPath(dest_root, dest, ".tmp")
+                        self._makeParentDir(temp)
+                        try:
+                            FileOps.copy(source, temp)
+                            self._replaceFromTemp(temp, dest)
+                        finally:
+                            if os.path.lexists(temp):
+                                FileOps.remove(temp)
+                        # internal, so removed if empty regardless of cleanup_empty_dirs
+                        self.cleanup_dirs[os.path.dirname(temp)] = dest_root
+                    else:
+                        try:
+                            FileOps.copy(source, dest)
+                        except IOError:
+                            FileOps.chmod(dest, 0o777)
+                            FileOps.copy(source, dest)
                     if self.config.verify_copy:
                         self.source.verifyCrcOnCopy(source_root, dest_root, source_file, dest_file, self.dest)
             self.source.updateDictOnCopy(source_root, dest_root, source_file, dest_file, self.dest)
+            if not self.config.dry_run:
+                self._checkpoint(dest_root, dest)
+            self._recordOp("copy", os.path.join(source_root, source_file), os.path.join(dest_root, dest_file), start)
         except Exception as e:
             self.log.append(["COPY ERROR", source_root, source_file, dest_root, dest_file, str(e)])
+            self._recordOp("copy", os.path.join(source_root, source_file), os.path.join(dest_root, dest_file), start, str(e))
             print(e)
 
-    def _moveFile(self, source_root: str, dest_root: str, source_file: str, dest_file: str) -> None:
+    def _replaceFromTemp(self, temp: str, dest: str) -> None:
+        # rename a completed temp file from config_dir into place
+        try:
+            FileOps.replace(temp, dest)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                # dest is on another file system than config_dir (a mount point in the tree), fallback to a plain copy
+                try:
+                    FileOps.copy(temp, dest)
+                except IOError:
+                    FileOps.chmod(dest, 0o777)
+                    FileOps.copy(temp, dest)
+            else:
+                FileOps.chmod(dest, 0o777)
+                FileOps.replace(temp, dest)
+
+    def _getPartialPath(self, dest_root: str, dest: str, ext: str) -> str:
+        # temp file for an incomplete copy to dest, named by the CRC of its path so an interrupted copy is found again
+        part_name = "%X%s" % (zlib.crc32(os.fsencode(dest)) & 0xFFFFFFFF, ext)
+        return os.path.join(dest_root, self.config.config_dir, "Partial", part_name)
+
+    def _makeParentDir(self, path: str) -> None:
+        # only check (and create) each parent directory once per run
+        head = os.path.dirname(path)
+        if head not in self.planned_dirs:
+            if not FileOps.isdir(head):
+                FileOps.makedirs(head, exist_ok=True)
+            self.planned_dirs.add(head)
+
+    def _planDirs(self, root_path: str, file_relative_paths: list) -> None:
+        # create all the parent directories needed by a batch once, parents before children (sorted), before any files are copied or moved
+        if self.config.dry_run:
+            return None
+        dirs = set(os.path.dirname(os.path.join(root_path, f)) for f in file_relative_paths) - self.planned_dirs
+        for head in sorted(dirs):
+            try:
+                FileOps.makedirs(head, exist_ok=True)
+                self.planned_dirs.add(head)
+            except Exception:
+                # leave it to the file operation to report the error
+                pass
+
+    def _copyObject(self, source_root: str, dest_root: str, source_file: str, source: str, dest: str) -> None:
+        # only called by _copyFile, store contents once under dedup_dir (keyed by crc, size, and mtime so linked paths keep matching attributes) and hardlink dest to it
+        source_side, _ = self._getScanners(source_root, dest_root)
+        entry = source_side.dict_current[source_file]
+        object_name = "%s-%s-%s" % (source_side.getCrc(source_file), entry["size"], int(entry["mtime"]))
+        object_path = os.path.join(dest_root, self.config.dedup_dir, object_name[:2], object_name)
+        created = False
+        if not os.path.exists(object_path):
+            self._makeParentDir(object_path)
+            FileOps.copy(source, object_path + ".tmp")
+            FileOps.move(object_path + ".tmp", object_path)
+            created = True
+        if os.path.lexists(dest):
+            try:
+                FileOps.remove(dest)
+            except IOError:
+                FileOps.chmod(dest, 0o777)
+                FileOps.remove(dest)
+        if not created and not self._sameContents(source, object_path):
+            # the key is not a strong hash, so a different file with the same key is stored as a regular copy
+            FileOps.copy(source, dest)
+            return None
+        try:
+            FileOps.link(object_path, dest)
+        except OSError:
+            # copying objects would store each file twice, and they would be pruned every run since they are never linked
+            self.use_dedup_store = False
+            self.log.colourPrint(getString("Unable to create hardlinks, files will be copied without the dedup store for the rest of this run"), "Y")
+            if created:
+                FileOps.remove(object_path)
+                self.cleanup_dirs[os.path.dirname(object_path)] = dest_root
+            FileOps.copy(source, dest)
+
+    def _sameContents(self, path_1: str, path_2: str) -> bool:
+        # byte for byte comparison of two files
+        with FileOps.open(path_1) as f_1, FileOps.open(path_2) as f_2:
+            for chunk in iter(lambda: f_1.read(1048576), b""):
+                if f_2.read(len(chunk)) != chunk:
+                    return False
+            return f_2.read(1) == b""
+
+    def _movePath(self, source_root: str, dest_root: str, source_file: str, dest_file: str) -> None:
+        # filesystem part of _moveFile (may run on a metadata worker)
+        dest = os.path.join(dest_root, dest_file)
+        self._makeParentDir(dest)
+        # rename silently replaces an existing file
+        if os.path.lexists(dest):
+            raise FileExistsError(errno.EEXIST, "File exists", dest)
+        FileOps.move(os.path.join(source_root, source_file), dest)
+
+    def _getArchiveName(self, archive_root: str, file_relative_path: str) -> str:
+        # archived and trashed files never replace an existing one (e.g. archived by an earlier run in the same minute), a number is added instead (name.1.ext)
+        name, ext = os.path.splitext(file_relative_path)
+        archive_file, i = file_relative_path, 0
+        while os.path.join(archive_root, archive_file) in self.archive_paths or os.path.lexists(os.path.join(archive_root, archive_file)):
+            i += 1
+            archive_file = "%s.%s%s" % (name, i, ext)
+        self.archive_paths.add(os.path.join(archive_root, archive_file))
+        return archive_file
+
+    def _moveFile(self, source_root: str, dest_root: str, source_file: str, dest_file: str, result: typing.Union[concurrent.futures.Future, None] = None) -> bool:
+        start = time.monotonic()
         try:
             self.log.append(["Move:", source_root, source_file, dest_root, dest_file])
             if not self.config.dry_run:
+                # result is from _startMetadataOps if the move was already started
                 source = os.path.join(source_root, source_file)
-                dest = os.path.join(dest_root, dest_file)
-                if not FileOps.isdir(os.path.dirname(dest)):
-                    FileOps.makedirs(os.path.dirname(dest))
-                FileOps.move(source, dest)
+                if result is not None:
+                    result.result()
+                else:
+                    self._movePath(source_root, dest_root, source_file, dest_file)
+                self.planned_dirs.discard(source)
                 if self.config.cleanup_empty_dirs:
-                    head = os.path.dirname(source)
-                    if len(FileOps.listdir(head)) == 0:
-                        FileOps.removedirs(head)
+                    self.cleanup_dirs[os.path.dirname(source)] = source_root
             self.source.updateDictOnMove(source_root, dest_root, source_file, dest_file, self.dest)
+            self._recordOp("move", os.path.join(source_root, source_file), os.path.join(dest_root, dest_file), start)
+            return True
         except Exception as e:
             self.log.append(["MOVE ERROR", source_root, source_file, dest_root, dest_file, str(e)])
+            self._recordOp("move", os.path.join(source_root, source_file), os.path.join(dest_root, dest_file), start, str(e))
+            print(e)
+            return False
+
+    def _deltaCopyFile(self, source_root: str, dest_root: str, file_relative_path: str) -> None:
+        start = time.monotonic()
+        try:
+            self.log.append(["Delta Copy:", source_root, file_relative_path, dest_root, file_relative_path])
+            source_side, dest_side = self._getScanners(source_root, dest_root)
+            if not self.config.dry_run:
+                source = os.path.join(source_root, file_relative_path)
+                dest = os.path.join(dest_root, file_relative_path)
+                block_size = self.config.delta_block_size
+                # use the block manifest from the database if it is still valid for the current dest, otherwise calculate it
+                dest_entry = dest_side.dict_current[file_relative_path]
+                if "blocks" in dest_entry and len(dest_entry["blocks"]) == -(-dest_entry["size"] // block_size):
+                    dest_blocks = dest_entry["blocks"]
+                else:
+                    dest_blocks = dest_side.calcBlockCrcs(dest, block_size)
+                # patch a clone of dest in config_dir, so dest is only replaced by a complete and verified new version
+                temp = self._getPartialPath(dest_root, dest, ".tmp")
+                self._makeParentDir(temp)
+                try:
+                    FileOps.clone(dest, temp)
+                    # the clone keeps the mode of dest, patch then copies the mode of source
+                    FileOps.chmod(temp, 0o600)
+                    source_blocks, source_crc = FileOps.patch(source, temp, dest_blocks, block_size)
+                    # verify the patched file, fallback to a full copy if it does not match
+                    if dest_side.calcCrc(temp) != source_crc:
+                        FileOps.copy(source, temp)
+                        if dest_side.calcCrc(temp) != source_crc:
+                            raise Exception("CRC Verification Failed")
+                    # the old version is archived with a logged move (dest is left as is if that fails)
+                    if not self._archiveFile(dest_root, file_relative_path):
+                        raise Exception("Could not archive the previous version")
+                    self._replaceFromTemp(temp, dest)
+                finally:
+                    if os.path.lexists(temp):
+                        FileOps.remove(temp)
+                # internal, so removed if empty regardless of cleanup_empty_dirs
+                self.cleanup_dirs[os.path.dirname(temp)] = dest_root
+            else:
+                self._archiveFile(dest_root, file_relative_path)
+            source_side.updateDictOnCopy(source_root, dest_root, file_relative_path, file_relative_path, dest_side)
+            if not self.config.dry_run:
+                for entry in [source_side.dict_current[file_relative_path], dest_side.dict_current[file_relative_path]]:
+                    entry["blocks"] = source_blocks
+                    entry["crc"] = source_crc
+                self._checkpoint(dest_root, dest)
+            self._recordOp("delta_copy", os.path.join(source_root, file_relative_path), os.path.join(dest_root, file_relative_path), start)
+        except Exception as e:
+            self.log.append(["DELTA COPY ERROR", source_root, file_relative_path, dest_root, file_relative_path, str(e)])
+            self._recordOp("delta_copy", os.path.join(source_root, file_relative_path), os.path.join(dest_root, file_relative_path), start, str(e))
+            print(e)
+
+    def _snapshotFile(self, root_path: str, snapshot_root: str, file_relative_path: str) -> None:
+        # only called by createSnapshot, a plain copy that is not logged or reported as a transfer (the snapshot is not part of the backup)
+        try:
+            if not self.config.dry_run:
+                source = os.path.join(root_path, file_relative_path)
+                dest = os.path.join(snapshot_root, file_relative_path)
+                if not os.path.lexists(source) and os.path.lexists(source + "~"):
+                    # files with forbidden extensions keep their trailing ~
+                    source, dest = source + "~", dest + "~"
+                if FileOps.isdir(source):
+                    if FileOps.islink(source):
+                        FileOps.copyff(source, dest)
+                    else:
+                        FileOps.makedirs(dest, exist_ok=True)
+                else:
+                    self._makeParentDir(dest)
+                    FileOps.copy(source, dest)
+        except Exception as e:
+            self.log.append(["SNAPSHOT ERROR", root_path, file_relative_path, str(e)])
+            print(e)
+
+    def _linkFile(self, source_root: str, dest_root: str, source_file: str, dest_file: str) -> bool:
+        # hardlink source to dest, returns False if the link could not be created (caller should copy instead)
+        try:
+            if not self.config.dry_run:
+                source = os.path.join(source_root, source_file)
+                dest = os.path.join(dest_root, dest_file)
+                self._makeParentDir(dest)
+                FileOps.link(source, dest)
+            return True
+        except Exception:
+            return False
+
+    def _copyFilesRsync(self, source_root: str, dest_root: str, files: list, copy_status: StatusBar) -> None:
+        # copy all files between a pair of roots with a single rsync process then log the results of each file like _copyFile
+        errors = {}
+        unverified = set()
+        file_set = set(files)
+        # rsync reports each file when it finishes, so a file is timed from the previous report (files that were not reported share the time left at the end)
+        times = {}
+        last_report = time.monotonic()
+        if not self.config.dry_run:
+            return_code, error_lines = 0, []
+            with tempfile.TemporaryFile() as files_from, tempfile.TemporaryFile("w+", errors="surrogateescape") as stderr:
+                files_from.write(b"\0".join(os.fsencode(f) for f in files))
+                files_from.flush()
+                files_from.seek(0)
+                try:
+                    proc = subprocess.Popen(self.rsync_args + ["--from0", "--files-from=-", "--out-format=%n",
+                                             os.path.join(source_root, ""), os.path.join(dest_root, "")],
+                                            stdin=files_from, stdout=subprocess.PIPE, stderr=stderr,
+                                            universal_newlines=True, errors="surrogateescape")
+                except Exception as e:
+                    # rsync is not installed or could not be started, every file in the batch failed
+                    for f in files:
+                        errors[f] = [str(e)]
+                    proc = None
+                if proc is not None:
+                    for line in proc.stdout:
+                        if line.rstrip("\n").rstrip("/") in file_set:
+                            copy_status.update(line.rstrip("\n"))
+                            times[line.rstrip("\n").rstrip("/")] = (last_report, time.monotonic())
+                            last_report = time.monotonic()
+                    return_code = proc.wait()
+                    stderr.seek(0)
+                    error_lines = stderr.read().splitlines()
+            # attribute errors to files using the paths quoted by rsync (temp files on the receiver look like .name.XXXXXX)
+            for line in error_lines:
+                match = re.search(r'"(.+)"', line)
+                if match:
+                    path = match.group(1)
+                    for root in [source_root, dest_root]:
+                        if path.startswith(os.path.join(root, "")):
+                            relative_path = os.path.relpath(path, root)
+                            head, tail = os.path.split(relative_path)
+                            if relative_path not in file_set and re.fullmatch(r"\..+\.[A-Za-z0-9]{6}", tail):
+                                relative_path = os.path.join(head, tail[1:-7])
+                            if self.config.force_posix_path_sep:
+                                relative_path = relative_path.replace(os.path.sep, "/")
+                            errors.setdefault(relative_path, []).append(line)
+            # the paths in an error may not be recognized, so all other files are verified by CRC if rsync failed
+            if return_code:
+                unattributed = " ".join(line for line in error_lines if not re.search(r'"(.+)"', line))
+                source_side, _ = self._getScanners(source_root, dest_root)
+                for f in files:
+                    if f not in errors and "dir" not in source_side.dict_current[f]:
+                        unverified.add(f)
+        end = time.monotonic()
+        for f in files:
+            start, finish = times.get(f, (last_report, end))
+            try:
+                self.log.append(["Copy:", source_root, f, dest_root, f])
+                if f in errors:
+                    raise Exception("rsync error: " + " ".join(errors[f]))
+                if f in unverified:
+                    try:
+                        self.source.verifyCrcOnCopy(source_root, dest_root, f, f, self.dest)
+                    except Exception as e:
+                        raise Exception("rsync error: %s return code %s (%s)" % (unattributed, return_code, str(e)))
+                elif not self.config.dry_run and self.config.verify_copy:
+                    self.source.verifyCrcOnCopy(source_root, dest_root, f, f, self.dest)
+                self.source.updateDictOnCopy(source_root, dest_root, f, f, self.dest)
+                if not self.config.dry_run:
+                    self._checkpoint(dest_root, os.path.join(dest_root, f))
+                self._recordOp("copy", os.path.join(source_root, f), os.path.join(dest_root, f), start, end=finish)
+            except Exception as e:
+                self.log.append(["COPY ERROR", source_root, f, dest_root, f, str(e)])
+                self._recordOp("copy", os.path.join(source_root, f), os.path.join(dest_root, f), start, str(e), end=finish)
+                print(e)
+
+    def _checkpoint(self, dest_root: str, dest: str) -> None:
+        # flush written files to disk in batches then save the databases, so completed work survives a crash at a fraction of the cost of an fsync per file
+        if not (self.config.sync_every_files or self.config.sync_every_bytes):
+            return None
+        self.sync_roots.add(dest_root)
+        if not FileOps.isdir(dest):
+            self.sync_files.append(dest)
+            self.sync_bytes += FileOps.stat(dest, follow_symlinks=False).st_size
+        if ((self.config.sync_every_files and len(self.sync_files) >= self.config.sync_every_files) or
+                (self.config.sync_every_bytes and self.sync_bytes >= self.config.sync_every_bytes)):
+            self.syncCheckpoint()
+
+    def _startMetadataOps(self, func: typing.Callable, args_list: list, parents: list) -> typing.Iterator:
+        """Yields a future for func(*args) for each args in args_list in order (or None if disabled), run on a bounded pool at most one window ahead of the caller, one worker per parent directory at a time"""
+        # the caller still logs and updates the databases in order by waiting on each future
+        # use with contextlib.closing, so if the caller raises (e.g. KeyboardInterrupt) no queued operation runs after it without being logged
+        if self.config.metadata_workers <= 1 or self.config.dry_run or len(args_list) < 2:
+            for _ in args_list:
+                yield None
+            return None
+        window = self.config.metadata_workers * 16
+        futures = [concurrent.futures.Future() for _ in args_list]
+        stop = threading.Event()
+        locks = {parent: threading.Lock() for parent in parents}
+
+        def runGroup(indexes: list) -> None:
+            with locks[parents[indexes[0]]]:
+                for i in indexes:
+                    if stop.is_set():
+                        return None
+                    try:
+                        futures[i].set_result(func(*args_list[i]))
+                    except Exception as e:
+                        futures[i].set_exception(e)
+
+        def submitWindow(start: int) -> None:
+            groups = {}
+            for i in range(start, min(start + window, len(args_list))):
+                groups.setdefault(parents[i], []).append(i)
+            for indexes in groups.values():
+                pool.submit(runGroup, indexes)
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.metadata_workers)
+        try:
+            submitWindow(0)
+            for i in range(len(args_list)):
+                # the next window is started once the caller reaches this one
+                if i % window == 0 and i + window < len(args_list):
+                    submitWindow(i + window)
+                yield futures[i]
+        finally:
+            # groups stop before their next operation, wait for the ones in progress
+            stop.set()
+            pool.shutdown(wait=True)
+
+    def syncCheckpoint(self) -> None:
+        """Flush files written since the last checkpoint to disk then the journal of completed operations"""
+        if not self.sync_roots:
+            return None
+        try:
+            for file_path, error in FileOps.sync(sorted(self.sync_roots), self.sync_files):
+                self.log.append(["SYNC ERROR", file_path, error])
+            # the completed operations are already in the journal, so only it needs to be synced (compacting it rewrites the whole database)
+            self.source.syncJournal()
+            self.dest.syncJournal()
+        except Exception as e:
+            self.log.append(["SYNC ERROR", str(e)])
+            print(e)
+        self.sync_roots, self.sync_files, self.sync_bytes = set(), [], 0
+
+    def cleanupEmptyDirs(self) -> None:
+        """Remove directories left empty by removed or moved files (and their parents up to the root), deepest first"""
+        # rmdir fails on directories that still have content, so no listing is necessary
+        heap = [(-d.count(os.path.sep), d) for d in self.cleanup_dirs]
+        heapq.heapify(heap)
+        while heap:
+            _, head = heapq.heappop(heap)
+            root_path = self.cleanup_dirs.pop(head, None)
+            if root_path is None or os.path.normcase(head) == os.path.normcase(root_path):
+                continue
+            try:
+                FileOps.rmdir(head)
+            except OSError:
+                continue
+            parent = os.path.dirname(head)
+            if parent not in self.cleanup_dirs:
+                self.cleanup_dirs[parent] = root_path
+                heapq.heappush(heap, (-parent.count(os.path.sep), parent))
+
+    def _compressFile(self, root_path: str, file_relative_path: str) -> None:
+        # queue an archived or trashed file for compression, started once nothing else can be moved to the name it is compressed to, then logged and indexed by finishCompression
+        path = os.path.join(root_path, file_relative_path)
+        if self.compression_pool is None or FileOps.islink(path) or not os.path.isfile(path):
+            return None
+        # already compressed files are skipped, so no job can write a name another job is reading
+        if os.path.splitext(path)[1] in [".gz", ".bz2", ".xz"]:
+            return None
+        self.compression_jobs.append((root_path, file_relative_path))
+
+    def _startCompression(self, root_path: str, file_relative_path: str) -> concurrent.futures.Future:
+        # compress a file queued by _compressFile on the bounded pool, the result is the entry for the index
+        self.compression_slots.acquire()
+        future = self.compression_pool.submit(FileOps.compress, os.path.join(root_path, file_relative_path), self.config.archive_compression)
+        future.add_done_callback(lambda _: self.compression_slots.release())
+        return future
+
+    def _writeIndex(self, index_path: str, index: dict) -> None:
+        # <archive_dir|trash_dir|snapshot_dir>/yymmdd-HHMM.json
+        if not self.config.dry_run:
+            writeJson(index_path, index, sort_keys=True)
+
+    def _removeObject(self, root_path: str, object_path: str) -> bool:
+        # remove an object from dedup_dir if no file links to it anymore (internal, so only errors are logged), returns True if removed
+        object_base = os.path.join(root_path, self.config.dedup_dir)
+        try:
+            if FileOps.stat(object_path, follow_symlinks=False).st_nlink > 1:
+                return False
+            FileOps.remove(object_path)
+            self.cleanup_dirs[os.path.dirname(object_path)] = root_path
+            return True
+        except Exception as e:
+            self.log.append(["PRUNE ERROR", object_base, os.path.relpath(object_path, object_base), str(e)])
+            print(e)
+            return False
+
+    def _removePartial(self, root_path: str, partial_dir: str, name: str) -> None:
+        # remove a partial copy, sidecar, or temp file from config_dir (internal, so only errors are logged)
+        try:
+            FileOps.remove(os.path.join(partial_dir, name))
+        except Exception as e:
+            self.log.append(["PARTIAL ERROR", partial_dir, name, str(e)])
             print(e)
 
     ##########################################################################
@@ -149,26 +635,79 @@ class FileManager:
         if not file_relative_paths:
             return None
         self.log.colourPrint(getString("Removing %s unique files from:\n%s") % (len(file_relative_paths), root_path), "B")
-        for f in file_relative_paths:
-            self._removeFile(root_path, f)
+        results = self._startMetadataOps(self._removePath,
+                                         [(root_path, f) for f in file_relative_paths],
+                                         [os.path.dirname(f) for f in file_relative_paths])
+        with contextlib.closing(results):
+            for f in file_relative_paths:
+                self._removeFile(root_path, f, result=next(results))
         self.log.colourPrint(getString("Removal completed!"), "NONE")
 
     def copyFiles(self, source_root: str, dest_root: str, source_files: list, dest_files: list) -> None:
         if not source_files:
             return None
         self.log.colourPrint(getString("Copying %s unique files from:\n%s\nto:\n%s") % (len(source_files), source_root, dest_root), "B")
-        copy_status = StatusBar("Copying", len(source_files), self.config.stdout_status_bar, gui=self.gui)
-        for i in range(len(source_files)):
-            copy_status.update(source_files[i])
-            self._copyFile(source_root, dest_root, source_files[i], dest_files[i])
+        self._planDirs(dest_root, dest_files)
+        if self.config.use_rsync and list(source_files) == list(dest_files) and not self.config.forbidden_extensions_list:
+            if self.config.copy_order or self.config.layout_order:
+                self.log.colourPrint(getString("copy_order and layout_order are ignored when copying with rsync"), "Y")
+            copy_status = StatusBar("Copying", len(source_files), self.config.stdout_status_bar, gui=self.gui)
+            self._copyFilesRsync(source_root, dest_root, list(source_files), copy_status)
+        else:
+            source_dict = self._getScanners(source_root, dest_root)[0].dict_current
+            sizes = [source_dict[f]["size"] if f in source_dict else 0 for f in source_files]
+            copy_status = StatusBar("Copying", len(source_files), self.config.stdout_status_bar, gui=self.gui, total_bytes=sum(sizes))
+            # the log is still kept in sorted order when copying in a different order
+            order = self._scheduleCopies(source_root, source_files, sizes)
+            reorder = bool(self.config.copy_order or self.config.layout_order)
+            log_start = self.log.holdRows() if reorder else self.log.getRowCount()
+            row_keys = []
+            for i in order:
+                copy_status.update(source_files[i], sizes[i])
+                self._copyFile(source_root, dest_root, source_files[i], dest_files[i])
+                row_keys += [i] * (self.log.getRowCount() - log_start - len(row_keys))
+            if reorder:
+                self.log.reorderRows(log_start, row_keys)
         copy_status.endProgress()
 
+    def _scheduleCopies(self, source_root: str, source_files: list, sizes: list) -> list:
+        """Returns the order to copy source_files in, according to copy_order or layout_order (path order by default)"""
+        order = list(range(len(source_files)))
+        if self.config.copy_order == "smallest":
+            order.sort(key=lambda i: sizes[i])
+        elif self.config.copy_order == "largest":
+            order.sort(key=lambda i: -sizes[i])
+        elif self.config.copy_order == "interleave":
+            # round robin between the devices files are read from, keeping path order on each
+            devices, queues = {}, {}
+            for i in order:
+                parent = os.path.dirname(os.path.join(source_root, source_files[i]))
+                if parent not in devices:
+                    try:
+                        devices[parent] = FileOps.stat(parent).st_dev
+                    except OSError:
+                        devices[parent] = None
+                queues.setdefault(devices[parent], []).append(i)
+            order = [i for group in itertools.zip_longest(*queues.values()) for i in group if i is not None]
+        elif self.config.layout_order and not self.config.dry_run:
+            # physical order of the source files on disk
+            use_extents = self.config.layout_order == "extent"
+            order.sort(key=lambda i: getLayoutKey(os.path.join(source_root, source_files[i]), use_extents))
+        return order
+
     def _recycleFiles(self, source_root: str, dest_root: str, source_files: list, dest_files: list) -> None:
         if not source_files:
             return None
         self.log.colourPrint(getString("Archiving %s unique files from:\n%s") % (len(source_files), source_root), "B")
-        for i in range(len(source_files)):
-            self._moveFile(source_root, dest_root, source_files[i], dest_files[i])
+        dest_files = [self._getArchiveName(dest_root, f) for f in dest_files]
+        self._planDirs(dest_root, dest_files)
+        results = self._startMetadataOps(self._movePath,
+                                         [(source_root, dest_root, source_files[i], dest_files[i]) for i in range(len(source_files))],
+                                         [os.path.dirname(f) for f in source_files])
+        with contextlib.closing(results):
+            for i in range(len(source_files)):
+                self._moveFile(source_root, dest_root, source_files[i], dest_files[i], next(results))
+                self._compressFile(dest_root, dest_files[i])
         self.log.colourPrint(getString("Archiving completed!"), "NONE")
 
     def handleDeletedFiles(self, root_path: str, file_relative_paths: list) -> None:
@@ -185,45 +724,180 @@ class FileManager:
             # conflicts shouldn't happen since moved is a subset of files from source_only and dest_only
             # depends on source_info.dirCompare(dest_info) otherwise source and dest keys will be reversed
             self.log.colourPrint(getString("Moving %s files to match both sides") % (len(moved_pairs)), "B")
+            moves = []
             for f in moved_pairs:
                 if f["match"] == "dest":
-                    side = self.config.source
-                    oldLoc = f["source"]
-                    newLoc = f["dest"]
+                    moves.append((self.config.source, f["source"], f["dest"]))
                 elif f["match"] == "source":
-                    side = self.config.dest
-                    oldLoc = f["dest"]
-                    newLoc = f["source"]
+                    moves.append((self.config.dest, f["dest"], f["source"]))
                 else:
                     raise Exception("Incorrect format for list of moved pair dictionaries")
+            for side in [self.config.source, self.config.dest]:
+                self._planDirs(side, [newLoc for move_side, _, newLoc in moves if move_side == side])
+            for side, oldLoc, newLoc in moves:
                 self._moveFile(side, side, oldLoc, newLoc)
             self.log.colourPrint(getString("Moving completed!"), "NONE")
 
-    def _archiveFile(self, root_path: str, file_relative_path: str) -> None:
-        if not self.config.noarchive:
-            archive_path = os.path.join(root_path, self.config.archive_dir, self.backup_time)
-            self._moveFile(root_path, archive_path, file_relative_path, file_relative_path)
+    def _archiveFile(self, root_path: str, file_relative_path: str, result: typing.Union[concurrent.futures.Future, None] = None, archive_file: typing.Union[str, None] = None) -> bool:
+        # archive_file is the name given to a move already started by handleChangedFiles, returns False if the file could not be archived
+        if self.config.noarchive:
+            return True
+        archive_path = os.path.join(root_path, self.config.archive_dir, self.backup_time)
+        if archive_file is None:
+            archive_file = self._getArchiveName(archive_path, file_relative_path)
+        if not self._moveFile(root_path, archive_path, file_relative_path, archive_file, result):
+            return False
+        self._compressFile(archive_path, archive_file)
+        return True
+
+    def finishCompression(self) -> None:
+        """Compress archived and trashed files (after all moves, so compressed names never collide with archived ones) then log them and update their indexes"""
+        if self.compression_pool is None:
+            return None
+        futures = [(root_path, frp, self._startCompression(root_path, frp)) for root_path, frp in self.compression_jobs]
+        indexes = {}
+        for root_path, file_relative_path, future in futures:
+            try:
+                entry = future.result()
+                entry["compressed"] = os.path.join(os.path.dirname(file_relative_path), entry["compressed"])
+                if self.config.force_posix_path_sep:
+                    entry["compressed"] = entry["compressed"].replace(os.path.sep, "/")
+                self.log.append(["Compress:", root_path, file_relative_path, root_path, entry["compressed"]])
+                indexes.setdefault(root_path, {})[file_relative_path] = entry
+            except Exception as e:
+                self.log.append(["COMPRESS ERROR", root_path, file_relative_path, str(e)])
+                print(e)
+        self.compression_pool.shutdown()
+        self.compression_pool, self.compression_jobs = None, []
+        # <source|dest>/<archive_dir|trash_dir>/yymmdd-HHMM.json
+        for root_path in indexes:
+            index = readJson(root_path + ".json")
+            index.update(indexes[root_path])
+            self._writeIndex(root_path + ".json", index)
+
+    def pruneObjects(self, root_path: str) -> None:
+        """Remove objects from dedup_dir that are no longer linked to any file (internal, so only errors are logged)"""
+        object_base = os.path.join(root_path, self.config.dedup_dir)
+        if self.config.dry_run or not FileOps.isdir(object_base):
+            return None
+        pruned = 0
+        for dir_path, _, file_list in FileOps.walk(object_base):
+            for object_name in file_list:
+                pruned += self._removeObject(root_path, os.path.join(dir_path, object_name))
+        if pruned:
+            self.log.colourPrint(getString("Removed %s unused objects from:\n%s") % (pruned, object_base), "NONE")
+
+    def clearPartials(self, root_path: str) -> None:
+        """Remove partial copies that can no longer be resumed (source removed or changed) and temp files left by interrupted atomic copies"""
+        partial_dir = os.path.join(root_path, self.config.config_dir, "Partial")
+        if self.config.dry_run or not FileOps.isdir(partial_dir):
+            return None
+        names = set(FileOps.listdir(partial_dir))
+        for name in sorted(names):
+            if name.endswith(".part"):
+                # same check as resumableCopy, a part without a sidecar would be copied from the start anyway
+                try:
+                    progress = readJson(os.path.join(partial_dir, name + ".json"))
+                    stat = FileOps.stat(progress["source"])
+                    if progress["size"] == stat.st_size and progress["mtime"] == stat.st_mtime:
+                        continue
+                except Exception:
+                    pass
+                if name + ".json" in names:
+                    self._removePartial(root_path, partial_dir, name + ".json")
+            elif name.endswith(".part.json") and name[:-5] in names:
+                continue
+            self._removePartial(root_path, partial_dir, name)
+        # internal, so removed if empty regardless of cleanup_empty_dirs
+        self.cleanup_dirs[partial_dir] = root_path
+
+    def createSnapshot(self, root_path: str, root_dict: dict) -> None:
+        """Create a point in time snapshot of root_path under snapshot_dir, hardlinking files unchanged since the previous snapshot"""
+        snapshot_base = os.path.join(root_path, self.config.snapshot_dir)
+        snapshot_root = os.path.join(snapshot_base, self.backup_time)
+        if FileOps.isdir(snapshot_root):
+            self.log.colourPrint(getString("Snapshot already exists, skipping: %s") % (snapshot_root), "Y")
+            return None
+        # find the previous snapshot from its database
+        prev_root, prev_db = None, {}
+        if FileOps.isdir(snapshot_base):
+            prev_times = sorted(f[:-5] for f in FileOps.listdir(snapshot_base) if f.endswith(".json") and f[:-5] < self.backup_time)
+            if prev_times:
+                prev_root = os.path.join(snapshot_base, prev_times[-1])
+                prev_db = readJson(prev_root + ".json")
+        self.log.colourPrint(getString("Creating snapshot of %s files in:\n%s") % (len(root_dict), snapshot_root), "B")
+        snapshot_status = StatusBar("Snapshot", len(root_dict), self.config.stdout_status_bar, gui=self.gui)
+        snapshot_db = {}
+        for f in sorted(root_dict):
+            snapshot_status.update(f)
+            entry = root_dict[f]
+            snapshot_db[f] = {k: entry[k] for k in entry if k != "blocks"}
+            # unchanged files (according to the database) are linked from the previous snapshot, everything else is copied
+            if prev_root is not None and f in prev_db and "dir" not in entry and prev_db[f] == snapshot_db[f]:
+                if self._linkFile(prev_root, snapshot_root, f, f):
+                    continue
+            self._snapshotFile(root_path, snapshot_root, f)
+        snapshot_status.endProgress()
+        self._writeIndex(snapshot_root + ".json", snapshot_db)
+
+    def _getScanners(self, source_root: str, dest_root: str) -> tuple:
+        if self.source.dir == source_root and self.dest.dir == dest_root:
+            return self.source, self.dest
+        elif self.dest.dir == source_root and self.source.dir == dest_root:
+            return self.dest, self.source
+        else:
+            raise Exception("Update Database Error")
+
+    def _useDeltaCopy(self, source_root: str, dest_root: str, source_dict: dict, dest_dict: dict, frp: str) -> bool:
+        return (self.config.delta_copy_threshold > 0 and
+                not self.config.use_rsync and
+                not self.config.use_dedup_store and
+                "dir" not in source_dict[frp] and "dir" not in dest_dict[frp] and
+                min(source_dict[frp]["size"], dest_dict[frp]["size"]) >= self.config.delta_copy_threshold and
+                os.path.splitext(frp)[1] not in self.config.forbidden_extensions_list and
+                not FileOps.islink(os.path.join(source_root, frp)) and
+                not FileOps.islink(os.path.join(dest_root, frp)))
+
+    def _replaceFile(self, source_root: str, dest_root: str, source_dict: dict, dest_dict: dict, frp: str,
+                     result: typing.Union[concurrent.futures.Future, None] = None, archive_file: typing.Union[str, None] = None) -> None:
+        """Archive and overwrite frp on dest_root, patching only changed blocks for large files if delta copies are enabled"""
+        if self._useDeltaCopy(source_root, dest_root, source_dict, dest_dict, frp):
+            self._deltaCopyFile(source_root, dest_root, frp)
+        else:
+            self._archiveFile(dest_root, frp, result, archive_file)
+            self._copyFile(source_root, dest_root, frp, frp)
 
     def handleChangedFiles(self, source_root: str, dest_root: str, source_dict: dict, dest_dict: dict, changed: list) -> None:
         if not changed:
             return None
         self.log.colourPrint(getString("Handling %s file changes per selection mode") % (len(changed)), "B")
-        copy_status = StatusBar("Copying", len(changed), self.config.stdout_status_bar, gui=self.gui)
+        # direction of each replacement per selection mode
+        replacements = []
         for frp in changed:
-            copy_status.update(frp)
             if self.config.select_mode == "source":
-                self._archiveFile(dest_root, frp)
-                self._copyFile(source_root, dest_root, frp, frp)
+                replacements.append((source_root, dest_root, source_dict, dest_dict, frp))
             elif self.config.select_mode == "dest":
-                self._archiveFile(source_root, frp)
-                self._copyFile(dest_root, source_root, frp, frp)
+                replacements.append((dest_root, source_root, dest_dict, source_dict, frp))
             elif self.config.select_mode == "new":
                 if source_dict[frp]["mtime"] > dest_dict[frp]["mtime"]:
-                    self._archiveFile(dest_root, frp)
-                    self._copyFile(source_root, dest_root, frp, frp)
+                    replacements.append((source_root, dest_root, source_dict, dest_dict, frp))
                 else:
-                    self._archiveFile(source_root, frp)
-                    self._copyFile(dest_root, source_root, frp, frp)
-            else:
-                break
+                    replacements.append((dest_root, source_root, dest_dict, source_dict, frp))
+        # archive the old versions at most one window ahead of the copies
+        archives = set()
+        if not self.config.noarchive:
+            archives = set(i for i, r in enumerate(replacements) if not self._useDeltaCopy(*r))
+        args_list, archive_files = [], {}
+        for i in sorted(archives):
+            _, root_path, _, _, frp = replacements[i]
+            archive_path = os.path.join(root_path, self.config.archive_dir, self.backup_time)
+            archive_files[i] = self._getArchiveName(archive_path, frp)
+            args_list.append((root_path, archive_path, frp, archive_files[i]))
+        results = self._startMetadataOps(self._movePath, args_list, [os.path.dirname(args[2]) for args in args_list])
+        sizes = [r[2][r[4]]["size"] for r in replacements]
+        copy_status = StatusBar("Copying", len(changed), self.config.stdout_status_bar, gui=self.gui, total_bytes=sum(sizes))
+        with contextlib.closing(results):
+            for i, replacement in enumerate(replacements):
+                copy_status.update(replacement[4], sizes[i])
+                self._replaceFile(*replacement, next(results) if i in archives else None, archive_files.get(i))
         copy_status.endProgress()
@@ -16,13 +16,17 @@
 import json
 import os
 import re
+import time
 import typing
 import zlib
 
 from .config import ConfigObject
+from .latency import latency
+from .metrics import metrics
 from .statusbar import StatusBar
 from .utils import (
     FileOps,
+    getLayoutKey,
     readJson,
     writeJson,
 )
@@ -57,15 +61,22 @@ class FileScanner:
         # Init variables from config
         self.compare_mode = config.compare_mode
         self.config_dir = config.config_dir
-        self.ignored_toplevel_folders = list(set([config.archive_dir, config.log_dir, config.trash_dir, config.config_dir]))
+        self.ignored_toplevel_folders = list(set([config.archive_dir, config.dedup_dir, config.log_dir, config.snapshot_dir, config.trash_dir, config.config_dir]))
         self.force_posix_path_sep = config.force_posix_path_sep
         self.write_database_x2 = config.write_database_x2 and not config.scan_only
         self.follow_symlinks = not config.nofollow
+        self.journal_checkpoint_ops = config.journal_checkpoint_ops
+        # durability checkpoints (sync_every_files or sync_every_bytes) only sync the journal, it is compacted after journal_checkpoint_ops (or when the database is saved)
+        self.use_journal = not (config.nolog or config.dry_run) and (config.journal_checkpoint_ops > 0 or config.sync_every_files > 0 or config.sync_every_bytes > 0)
+        self.layout_order = config.layout_order
         # Init other variables
         self.dir = directory_root_path
         self.other_dir = other_root_path
+        self.side = "source" if directory_root_path == config.source else "dest"
         self.unique_id = unique_id
         self.gui = gui
+        self.journal = None
+        self.journal_ops = 0
 
     def getDicts(self) -> tuple:
         """Returns tuple of dictionaries: current, prev"""
@@ -81,11 +92,16 @@ class FileScanner:
                 self.set_dirs,
                 self.set_unmodified)
 
-    def saveDatabase(self, db_name: str = "database.json") -> None:
-        """Write database to config_dir on self and other if enabled"""
+    def getSelfEntry(self) -> str:
         self_entry = os.path.join(self.config_dir, "database")
         if self.force_posix_path_sep:
             self_entry = self_entry.replace(os.path.sep, "/")
+        return self_entry
+
+    def saveDatabase(self, db_name: str = "database.json") -> None:
+        """Write database to config_dir on self and other if enabled"""
+        start = time.monotonic()
+        self_entry = self.getSelfEntry()
         self_crc = self.calcDatabaseCrc(self.dict_current)
         assert self_entry not in self.dict_current
         self.dict_current[self_entry] = {"size": 0, "mtime": 0, "crc": self_crc, "dir": False}
@@ -94,9 +110,14 @@ class FileScanner:
             other_db_path = os.path.join(self.other_dir, self.config_dir, "database-%s%s" % (self.unique_id, db_name[8:]))
             writeJson(other_db_path, self.dict_current, sort_keys=True)
         _ = self.dict_current.pop(self_entry)
+        # the journal is no longer needed once its operations are in the database
+        if db_name == "database.json":
+            self.truncateJournal()
+        metrics.add("backupy_database_seconds", time.monotonic() - start, op="save", side=self.side)
 
     def loadDatabase(self, use_cold_storage: bool = False) -> None:
         """Load database from config_dir"""
+        start = time.monotonic()
         if use_cold_storage:
             local_dict = self.getDatabaseX2(False)
             self.dict_current = local_dict.copy()
@@ -106,6 +127,109 @@ class FileScanner:
             db_path = os.path.join(self.dir, self.config_dir, "database.json")
             self.dict_prev = readJson(db_path)
             self.verifyDatabaseCrc(self.dict_prev, db_path)
+            self.replayJournal(self.dict_prev)
+        metrics.add("backupy_database_seconds", time.monotonic() - start, op="load", side=self.side)
+
+    def journalOp(self, op: str, path: str, entry: typing.Union[dict, None] = None, old_path: typing.Union[str, None] = None) -> None:
+        """Append a completed file operation to the journal (if enabled) and periodically compact it into the database of the previous run"""
+        if not self.use_journal:
+            return None
+        if self.journal is None:
+            journal_path = os.path.join(self.dir, self.config_dir, "journal.jsonl")
+            if not os.path.isdir(os.path.dirname(journal_path)):
+                os.makedirs(os.path.dirname(journal_path))
+            self.journal = open(journal_path, "a", encoding="utf-8", errors="surrogateescape")
+        record = {"op": op, "path": path}
+        if entry is not None:
+            record["entry"] = entry
+        if old_path is not None:
+            record["old"] = old_path
+        self.journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.journal.flush()
+        self.journal_ops += 1
+        if self.journal_checkpoint_ops > 0 and self.journal_ops >= self.journal_checkpoint_ops:
+            try:
+                self.compactJournal()
+            except Exception as e:
+                # the journal is kept and still replayed
+                print("Could not compact journal: %s" % (str(e)))
+
+    def compactJournal(self) -> None:
+        """Apply the journal to database.json then truncate it, dict_current is never saved mid-run since files not processed yet must keep their previous state"""
+        if self.journal is None:
+            return None
+        db_path = os.path.join(self.dir, self.config_dir, "database.json")
+        database = readJson(db_path)
+        self.verifyDatabaseCrc(database, db_path)
+        self.replayJournal(database)
+        self_entry = self.getSelfEntry()
+        database[self_entry] = {"size": 0, "mtime": 0, "crc": self.calcDatabaseCrc(database), "dir": False}
+        # replaced atomically, a crash before the journal is removed only replays it again
+        with open(db_path + ".tmp", "w", encoding="utf-8", errors="surrogateescape") as json_file:
+            json.dump(database, json_file, indent=1, separators=(',', ': '), sort_keys=True, ensure_ascii=False)
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        os.replace(db_path + ".tmp", db_path)
+        self.truncateJournal()
+
+    def syncJournal(self) -> None:
+        """Flush the journal to disk, so the operations in it survive a crash without rewriting the database"""
+        if self.journal is not None:
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def truncateJournal(self) -> None:
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        journal_path = os.path.join(self.dir, self.config_dir, "journal.jsonl")
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+        self.journal_ops = 0
+
+    def replayJournal(self, database: dict) -> None:
+        """Apply operations from the journal of an interrupted run to database (operations are idempotent)"""
+        journal_path = os.path.join(self.dir, self.config_dir, "journal.jsonl")
+        if not os.path.exists(journal_path):
+            return None
+        with open(journal_path, "r", encoding="utf-8", errors="surrogateescape") as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # incomplete last line from a crash
+                    continue
+                if record["op"] == "copy":
+                    database[record["path"]] = record["entry"]
+                elif record["op"] == "move":
+                    _ = database.pop(record["old"], None)
+                    database[record["path"]] = record["entry"]
+                elif record["op"] == "remove":
+                    _ = database.pop(record["path"], None)
+
+    def loadPlanEntries(self, entries: dict, targets: list = []) -> list:
+        """Use entries from a transfer plan in place of a scan after checking them with a quick stat, returns files that no longer match"""
+        # targets are copied or moved to on this side, so they must still not exist unless they are entries
+        stale = sorted(set(f for f in targets if f not in entries and (os.path.lexists(os.path.join(self.dir, f)) or os.path.lexists(os.path.join(self.dir, f + "~")))))
+        for relative_path in sorted(entries):
+            entry = entries[relative_path]
+            full_path = os.path.join(self.dir, relative_path)
+            try:
+                if "dir" in entry:
+                    if not FileOps.isdir(full_path) or self.symlinkCrc(full_path) != entry["crc"]:
+                        stale.append(relative_path)
+                else:
+                    if not os.path.lexists(full_path) and os.path.lexists(full_path + "~"):
+                        full_path += "~"
+                    stat = FileOps.stat(full_path, follow_symlinks=self.follow_symlinks)
+                    if stat.st_size != entry["size"] or stat.st_mtime != entry["mtime"]:
+                        stale.append(relative_path)
+            except OSError:
+                stale.append(relative_path)
+        # files outside the plan keep their entries from the previous run
+        self.dict_current = self.dict_prev.copy()
+        self.dict_current.update(entries)
+        return stale
 
     def getDatabaseX2(self, fallback: bool = True) -> dict:
         """Get the 'last seen' database of this directory from the perspective of the other directory"""
@@ -122,9 +246,7 @@ class FileScanner:
 
     def verifyDatabaseCrc(self, database: dict, abs_db_path: str) -> None:
         """Verify the data in the database matches the CRC and pops the entry, otherwise raises exception"""
-        self_entry = os.path.join(self.config_dir, "database")
-        if self.force_posix_path_sep:
-            self_entry = self_entry.replace(os.path.sep, "/")
+        self_entry = self.getSelfEntry()
         if self_entry in database:
             crc_record = database.pop(self_entry)["crc"]
             crc_calc = self.calcDatabaseCrc(database)
@@ -145,28 +267,36 @@ class FileScanner:
     def updateDictOnCopy(self, source_root: str, dest_root: str, source_file: str, dest_file: str, other_scanner: 'FileScanner') -> None:
         if self.dir == source_root and other_scanner.dir == dest_root:
             other_scanner.dict_current[dest_file] = self.dict_current[source_file].copy()
+            other_scanner.journalOp("copy", dest_file, other_scanner.dict_current[dest_file])
         elif self.dir == dest_root and other_scanner.dir == source_root:
             self.dict_current[dest_file] = other_scanner.dict_current[source_file].copy()
+            self.journalOp("copy", dest_file, self.dict_current[dest_file])
         else:
             raise Exception("Update Database Error")
 
     def updateDictOnMove(self, source_root: str, dest_root: str, source_file: str, dest_file: str, other_scanner: 'FileScanner') -> None:
         if source_root == dest_root == self.dir:
             self.dict_current[dest_file] = self.dict_current.pop(source_file)
+            self.journalOp("move", dest_file, self.dict_current[dest_file], source_file)
         elif source_root == dest_root == other_scanner.dir:
             other_scanner.dict_current[dest_file] = other_scanner.dict_current.pop(source_file)
+            other_scanner.journalOp("move", dest_file, other_scanner.dict_current[dest_file], source_file)
         elif source_root == self.dir and dest_root != other_scanner.dir:
             _ = self.dict_current.pop(source_file)
+            self.journalOp("remove", source_file)
         elif source_root == other_scanner.dir and dest_root != self.dir:
             _ = other_scanner.dict_current.pop(source_file)
+            other_scanner.journalOp("remove", source_file)
         else:
             raise Exception("Update Database Error")
 
     def updateDictOnRemove(self, root_path: str, file_relative_path: str, other_scanner: 'FileScanner') -> None:
         if root_path == self.dir:
             _ = self.dict_current.pop(file_relative_path)
+            self.journalOp("remove", file_relative_path)
         elif root_path == other_scanner.dir:
             _ = other_scanner.dict_current.pop(file_relative_path)
+            other_scanner.journalOp("remove", file_relative_path)
         else:
             raise Exception("Update Database Error")
 
@@ -181,9 +311,15 @@ class FileScanner:
     def calcCrc(self, file_path: str, prev: int = 0) -> str:
         try:
             if self.follow_symlinks or not FileOps.islink(file_path):
+                start = time.monotonic() if latency.enabled else 0
                 with FileOps.open(file_path) as f:
                     for line in f:
                         prev = zlib.crc32(line, prev)
+                    if (latency.enabled or metrics.enabled) and os.path.dirname(file_path) != os.path.join(self.dir, self.config_dir):
+                        # files only, not databases
+                        latency.record("hash", file_path, time.monotonic() - start)
+                        metrics.add("backupy_files", 1, op="hash", side=self.side)
+                        metrics.add("backupy_bytes", f.tell(), op="hash", side=self.side)
                 return "%X" % (prev & 0xFFFFFFFF)
             else:
                 return self.symlinkCrc(file_path)
@@ -191,6 +327,17 @@ class FileScanner:
             # file either removed by user, or another program such as antimalware (using realtime monitoring) during scan, or lack permissions
             raise Exception("Exiting, error trying to read file: " + file_path)
 
+    def calcBlockCrcs(self, file_path: str, block_size: int) -> list:
+        """Returns a manifest of CRCs for each fixed size block of a file (used for delta copies)"""
+        blocks = []
+        try:
+            with FileOps.open(file_path) as f:
+                for block in iter(lambda: f.read(block_size), b""):
+                    blocks.append("%X" % (zlib.crc32(block) & 0xFFFFFFFF))
+            return blocks
+        except Exception:
+            raise Exception("Exiting, error trying to read file: " + file_path)
+
     def symlinkCrc(self, file_path: str) -> str:
         if FileOps.islink(file_path):
             crc = zlib.crc32(FileOps.readlink(file_path).encode())
@@ -243,6 +390,9 @@ class FileScanner:
         if FileOps.isdir(self.dir) and self.dict_current == {}:
             total = sum(len(f) for r, d, f in FileOps.walk(self.dir))
             scan_status = StatusBar("Scanning", total, stdout_status_bar, gui=self.gui)
+            # when hashing files, they can be deferred and read in their physical order on disk instead of directory order
+            deferred_files = []
+            defer_scan = self.layout_order and self.compare_mode in ["attr+", "crc"]
             # will never enable followlinks, adds too many possible issues and complexity in handling them
             # may add notification if backupy encounters a directory it cannot access (likely due to permissions)
             for dir_path, subdir_list, file_list in FileOps.walk(self.dir, onerror=None, followlinks=False):
@@ -261,7 +411,11 @@ class FileScanner:
                 for subdir in subdir_list:
                     full_path = os.path.join(dir_path, subdir)
                     try:
-                        if len(FileOps.listdir(full_path)) == 0 or FileOps.islink(full_path):
+                        start = time.monotonic() if latency.enabled else 0
+                        dir_entries = FileOps.listdir(full_path)
+                        if latency.enabled:
+                            latency.record("listdir", full_path, time.monotonic() - start)
+                        if len(dir_entries) == 0 or FileOps.islink(full_path):
                             # track empty directories and symbolic links to directories with a dummy entry, non-empty directories should not have entries, they are handled automatically by having files inside them
                             relative_path = os.path.relpath(full_path, self.dir)
                             if self.force_posix_path_sep:
@@ -276,9 +430,21 @@ class FileScanner:
                     relative_path = os.path.relpath(full_path, self.dir)
                     if self.force_posix_path_sep:
                         relative_path = relative_path.replace(os.path.sep, "/")
+                    if defer_scan:
+                        deferred_files.append((full_path, relative_path))
+                    else:
+                        scan_status.update(relative_path)
+                        self.scanFile(full_path, relative_path)
+            if defer_scan:
+                use_extents = self.layout_order == "extent"
+                deferred_files.sort(key=lambda f: getLayoutKey(f[0], use_extents))
+                for full_path, relative_path in deferred_files:
                     scan_status.update(relative_path)
                     self.scanFile(full_path, relative_path)
             scan_status.endProgress()
+            if metrics.enabled:
+                metrics.add("backupy_files", len(self.dict_current) - len(self.set_dirs), op="scan", side=self.side)
+                metrics.add("backupy_bytes", sum(entry["size"] for entry in self.dict_current.values()), op="scan", side=self.side)
             # check for missing (or moved) files
             for relative_path in (set(self.dict_prev) - set(self.dict_current)):
                 if "dir" not in self.dict_prev[relative_path]:
@@ -287,7 +453,10 @@ class FileScanner:
 
     def scanFile(self, full_path: str, relative_path: str) -> None:
         # get file attributes and create entry
+        start = time.monotonic() if latency.enabled else 0
         stat = FileOps.stat(full_path, follow_symlinks=self.follow_symlinks)
+        if latency.enabled:
+            latency.record("stat", full_path, time.monotonic() - start)
         size = stat.st_size
         mtime = stat.st_mtime
         if self.forbidden_extensions_list:
@@ -308,6 +477,9 @@ class FileScanner:
                 self.set_unmodified.add(relative_path)
                 if self.compare_mode in ["attr", "attr+"] and "crc" in self.dict_prev[relative_path] and "crc" not in self.dict_current[relative_path]:
                     self.dict_current[relative_path]["crc"] = self.dict_prev[relative_path]["crc"]
+                # keep block manifest for delta copies
+                if "blocks" in self.dict_prev[relative_path]:
+                    self.dict_current[relative_path]["blocks"] = self.dict_prev[relative_path]["blocks"]
             else:
                 # changed file (or corrupted and added to self.set_crc_errors by fileMatch)
                 if relative_path not in self.set_crc_errors:
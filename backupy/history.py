@@ -0,0 +1,182 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# https://github.com/elesiuta/backupy
+
+import csv
+import io
+import os
+import sqlite3
+import zipfile
+
+from .config import ConfigObject
+from .utils import getString, readCompressed, readJson
+
+
+class HistoryIndex:
+    def __init__(self, log_dir: str):
+        """SQLite index of log rows by path at <log_dir>/history.sqlite, updated incrementally from the bytes of each log not yet read"""
+        self.log_dir = log_dir
+        self.db = sqlite3.connect(os.path.join(log_dir, "history.sqlite"))
+        self.db.execute("CREATE TABLE IF NOT EXISTS logs (name TEXT PRIMARY KEY, offset INTEGER, row INTEGER, section TEXT, complete INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS rows (path TEXT, run TEXT, log TEXT, row INTEGER, section TEXT, action TEXT, "
+                        "root TEXT, file TEXT, other_root TEXT, other_file TEXT, info TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS rows_path ON rows (path)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS rows_log ON rows (log)")
+        self.db.commit()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def isLog(self, name: str) -> bool:
+        return name.startswith("log-") and name.endswith(".csv") and not name.endswith("-plus.csv")
+
+    def forgetLog(self, name: str) -> None:
+        """Remove the rows of a log that is being written again from the start"""
+        self.db.execute("DELETE FROM rows WHERE log = ?", (name,))
+        self.db.execute("DELETE FROM logs WHERE name = ?", (name,))
+        self.db.commit()
+
+    def parseRow(self, row: list) -> list:
+        """Returns (path, action, root, file, other_root, other_file, info) for each path in a row of a log, or nothing for other rows"""
+        if len(row) < 3 or not row[2]:
+            return []
+        if row[0] in ["Copy:", "Move:", "Delta Copy:", "Compress:", "COPY ERROR", "MOVE ERROR", "DELTA COPY ERROR"] and len(row) >= 5:
+            # operations, also found from the path they were moved or copied to
+            entry = (row[0], row[1], row[2], row[3], row[4], row[5] if len(row) > 5 else "")
+            if row[4] != row[2]:
+                return [(row[2],) + entry, (row[4],) + entry]
+            return [(row[2],) + entry]
+        if row[0] in ["Remove:", "REMOVE ERROR"]:
+            return [(row[2], row[0], row[1], row[2], "", "", row[3] if len(row) > 3 else "")]
+        if row[0] in ["File:", "Source:", "Dest:", ""]:
+            # file info (header, subheader, path, size, modified, hash)
+            return [(row[2], row[0] or "File:", row[1], row[2], "", "", ", ".join(row[3:]))]
+        return []
+
+    def getState(self, name: str, size: int) -> tuple:
+        """Returns the offset, row, and section a log was indexed up to"""
+        state = self.db.execute("SELECT offset, row, section FROM logs WHERE name = ?", (name,)).fetchone()
+        if state is None:
+            return 0, 0, ""
+        if size < state[0]:
+            # rewritten (same run time)
+            self.forgetLog(name)
+            return 0, 0, ""
+        return state
+
+    def ingestLog(self, file_path: str) -> int:
+        """Index the complete rows appended to a log since it was last read, returns the number of rows read"""
+        name = os.path.basename(file_path)
+        size = os.path.getsize(file_path)
+        offset, row_number, section = self.getState(name, size)
+        if size == offset:
+            return 0
+        with open(file_path, "rb") as f:
+            f.seek(offset)
+            data = f.read(size - offset)
+        # only read up to the last complete row, the rest is read once it is finished
+        data = data[:data.rfind(b"\n") + 1]
+        return self.ingestRows(name, data, offset, row_number, section, False)
+
+    def ingestData(self, name: str, data: bytes) -> int:
+        """Index the rows of a finished log (compressed or compacted) not indexed while it was being written"""
+        offset, row_number, section = self.getState(name, len(data))
+        return self.ingestRows(name, data[offset:], offset, row_number, section, True)
+
+    def ingestRows(self, name: str, data: bytes, offset: int, row_number: int, section: str, complete: bool) -> int:
+        run = name[4:-4]
+        records = []
+        rows = list(csv.reader(io.StringIO(data.decode("utf-8", "backslashreplace"), newline="")))
+        for row in rows:
+            row_number += 1
+            if len(row) == 1 and row[0].startswith("###"):
+                section = row[0].strip("# ")
+            for entry in self.parseRow(row):
+                records.append(entry[:1] + (run, name, row_number, section) + entry[1:])
+        self.db.executemany("INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", records)
+        self.db.execute("INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?, ?)", (name, offset + len(data), row_number, section, complete))
+        self.db.commit()
+        return len(rows)
+
+    def update(self) -> int:
+        """Index new rows of every log in log_dir, returns the number of rows read"""
+        total = 0
+        complete = set(r[0] for r in self.db.execute("SELECT name FROM logs WHERE complete"))
+        for name in sorted(os.listdir(self.log_dir)):
+            file_path = os.path.join(self.log_dir, name)
+            if self.isLog(name):
+                total += self.ingestLog(file_path)
+            elif self.isLog(os.path.splitext(name)[0]) and os.path.splitext(name)[0] not in complete:
+                # compressed with log_compression
+                total += self.ingestData(os.path.splitext(name)[0], readCompressed(file_path))
+            elif name.startswith("logs-") and name.endswith(".zip"):
+                # compacted into monthly archives after log_retention_days
+                with zipfile.ZipFile(file_path, "r") as archive:
+                    for log_name in archive.namelist():
+                        if self.isLog(log_name) and log_name not in complete:
+                            total += self.ingestData(log_name, archive.read(log_name))
+        return total
+
+    def lookup(self, path: str) -> list:
+        """Rows for path (either path separator) in order of runs, as dicts"""
+        paths = list(set([path, path.replace(os.path.sep, "/"), path.replace("/", os.path.sep)]))
+        cursor = self.db.execute("SELECT run, section, action, root, file, other_root, other_file, info FROM rows WHERE path IN (%s) "
+                                 "ORDER BY run, log, row" % (", ".join("?" * len(paths))), paths)
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, r)) for r in cursor.fetchall()]
+
+
+def findRoot(path: str, config_dir: str) -> str:
+    """The closest parent of path with a config_dir (path may no longer exist), or an empty string"""
+    root = os.path.dirname(os.path.abspath(path))
+    while True:
+        if os.path.isdir(os.path.join(root, config_dir)):
+            return root
+        if os.path.dirname(root) == root:
+            return ""
+        root = os.path.dirname(root)
+
+
+def printHistory(path: str, source: str = "", config_dir: str = "") -> int:
+    """Print every logged change of path (relative to source, found from path if not provided) and where its old versions went"""
+    # the saved config is in config_dir, so only it needs to be provided if it is not the default
+    config = ConfigObject({"config_dir": config_dir or None})
+    if not source:
+        source = findRoot(path, config.config_dir)
+        if not source:
+            print(getString("Could not find a backupy source containing: %s") % (path))
+            return 1
+        path = os.path.relpath(os.path.abspath(path), source)
+    config_path = os.path.join(source, config.config_dir, "config.json")
+    if os.path.isfile(config_path):
+        config = ConfigObject(readJson(config_path))
+    log_dir = os.path.join(source, config.log_dir)
+    if not os.path.isdir(log_dir):
+        print(getString("No logs found in: %s") % (log_dir))
+        return 1
+    history = HistoryIndex(log_dir)
+    history.update()
+    rows = history.lookup(path)
+    history.close()
+    for r in rows:
+        if r["other_root"]:
+            # copies and moves, including where a version was archived or trashed
+            print("%s  %-24s %-12s %s -> %s %s" % (r["run"], r["section"], r["action"], os.path.join(r["root"], r["file"]),
+                                                   os.path.join(r["other_root"], r["other_file"]), r["info"]))
+        else:
+            print("%s  %-24s %-12s %s %s %s" % (r["run"], r["section"], r["action"], r["root"], r["file"], r["info"]))
+    if not rows:
+        print(getString("No history found for: %s") % (path))
+        return 1
+    return 0
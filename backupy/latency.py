@@ -0,0 +1,73 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# https://github.com/elesiuta/backupy
+
+import bisect
+import heapq
+import itertools
+import threading
+
+
+class LatencyTracker:
+    # upper bounds of histogram buckets in seconds, the last bucket has no upper bound
+    buckets = [0.0001, 0.001, 0.01, 0.1, 1, 10]
+    bucket_labels = ["<100us", "<1ms", "<10ms", "<100ms", "<1s", "<10s", ">=10s"]
+
+    def __init__(self):
+        """Time of each file operation by type, keeping a histogram and the slowest paths (bounded heap), nothing is timed until open sets how many to keep"""
+        self.enabled = False
+        self.top_n = 0
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.totals = {}
+        self.slowest = {}
+        self.counter = itertools.count()
+
+    def open(self, top_n: int) -> None:
+        self.top_n = top_n
+        self.histograms, self.totals, self.slowest = {}, {}, {}
+        self.enabled = True
+
+    def close(self) -> None:
+        self.enabled = False
+
+    def record(self, op: str, path: str, duration: float) -> None:
+        if not self.enabled:
+            return None
+        with self.lock:
+            if op not in self.histograms:
+                self.histograms[op] = [0] * len(self.bucket_labels)
+                self.totals[op] = 0.0
+                self.slowest[op] = []
+            self.histograms[op][bisect.bisect_right(self.buckets, duration)] += 1
+            self.totals[op] += duration
+            # min heap of the slowest, the counter breaks ties without comparing paths
+            heap = self.slowest[op]
+            if len(heap) < self.top_n:
+                heapq.heappush(heap, (duration, next(self.counter), path))
+            elif duration > heap[0][0]:
+                heapq.heapreplace(heap, (duration, next(self.counter), path))
+
+    def getReport(self) -> list:
+        """Returns (op, count, total seconds, histogram, slowest (seconds, path) first) for each operation type"""
+        report = []
+        with self.lock:
+            for op in sorted(self.histograms):
+                slowest = [(duration, path) for duration, _, path in sorted(self.slowest[op], reverse=True)]
+                report.append((op, sum(self.histograms[op]), self.totals[op], dict(zip(self.bucket_labels, self.histograms[op])), slowest))
+        return report
+
+
+# module level so calcCrc and _recordOp can check latency.enabled before reading the clock, closed by LogManager once the report is logged
+latency = LatencyTracker()
@@ -13,16 +13,18 @@
 
 # https://github.com/elesiuta/backupy
 
+import csv
+import io
 import os
 import shutil
 import time
+import zipfile
 
 from .config import ConfigObject
 from .filescanner import FileScanner
-from .utils import (
-    getString,
-    writeCsv,
-)
+from .history import HistoryIndex
+from .latency import latency
+from .utils import FileOps, compressFile, getString, readCompressed, readJson, writeJson
 
 
 class LogManager:
@@ -32,6 +34,31 @@ class LogManager:
         self._log = []
         self._log_columns = []
         self._log_row_split = False
+        # rows are written to the log file as they are appended, only rows not yet written (or held for reordering) are kept
+        self._log_start = 0
+        self._log_hold = None
+        self._log_flush_rows = 1000
+        self._log_files = []
+        self._log_paths = []
+        self._log_crc_offsets = []
+        self._log_opened = False
+        self._history = None
+        # log summary (write_log_summary) built from rows as they are written, only the current row is kept
+        self._summary_columns = ["Section",
+                                 "Header", "Subheader", "Path", "Size", "Modified", "Hash",
+                                 "Header", "Subheader", "Path", "Size", "Modified", "Hash",
+                                 "Header", "Subheader", "Path", "Size", "Modified", "Hash",
+                                 "Header", "Subheader", "Path", "Size", "Modified", "Hash"]
+        self._summary_offsets = {"Section": 0, "Header": 1, "Subheader": 2, "Path": 3, "Size": 4, "Modified": 5, "Hash": 6}
+        self._summary_row = self._summary_columns.copy()
+        self._summary_prev_section = ""
+        self._summary_new_section = False
+        self._summary_entry_number = 0
+        self._summary_size = 0
+        self._summary_opened = False
+        self._summary_file = None
+        # formatted modification times, many files share the same mtime
+        self._time_cache = {}
         self.backup_time = backup_time
         self.gui = gui
         self.terminal_width = shutil.get_terminal_size()[0]
@@ -50,81 +77,247 @@ class LogManager:
         # columns corresponds to the column names of each item in entry or an empty string to omit from summary
         # columns should be an empty list if this entry should be omitted entirely from summary
         # len(columns) should be >= len(entry) or an empty list
+        if self.config.nolog:
+            # nothing is written, only count rows
+            self._log_start += 1
+            return None
         self._log.append(entry)
         if columns:
             self._log_columns.append(columns + [row_split or self._log_row_split])
             self._log_row_split = False
         else:
             self._log_columns.append([])
+        if len(self._log) >= self._log_flush_rows:
+            self.flushRows()
 
     def appendNewRowFlag(self) -> None:
         self._log_row_split = True
 
-    def convertLog(self) -> list:
-        # convert existing log into log summary
-        # combines multiple log entries into a single row
+    def getRowCount(self) -> int:
+        return self._log_start + len(self._log)
+
+    def holdRows(self) -> int:
+        # keep rows from this point in memory until reorderRows is called, returns the row count to pass to it
+        self._log_hold = self.getRowCount()
+        return self._log_hold
+
+    def reorderRows(self, start: int, row_keys: list) -> None:
+        # stable sort the rows appended since start by row_keys (one key per row), for operations that were not performed in log order
+        self._log_hold = None
+        if self.config.nolog:
+            return None
+        start -= self._log_start
+        order = sorted(range(len(row_keys)), key=lambda i: row_keys[i])
+        self._log[start:] = [self._log[start + i] for i in order]
+        self._log_columns[start:] = [self._log_columns[start + i] for i in order]
+
+    def formatRow(self, row: list) -> list:
+        # format file attributes (stored raw by printFileInfo) and apply root_alias_log and force_posix_path_sep to a row as it is written
+        if row and type(row[-1]) == dict:
+            row = row[:-1] + self.prettyAttr(row[-1])
+        else:
+            row = row.copy()
+        for j in range(len(row)):
+            if type(row[j]) == str:
+                if self.config.root_alias_log:
+                    row[j] = row[j].replace(self.config.source, getString("<source>"))
+                    row[j] = row[j].replace(self.config.dest, getString("<dest>"))
+                if self.config.force_posix_path_sep:
+                    row[j] = row[j].replace(os.path.sep, "/")
+        return row
+
+    def openLogFiles(self) -> None:
+        # <source>/.backupy/Logs/log-yymmdd-HHMM.csv (and optionally a copy on dest), truncated when first opened then appended to
+        file_paths = [os.path.join(self.config.source, self.config.log_dir, "log-" + self.backup_time + ".csv")]
+        if self.config.write_log_dest:
+            file_paths.append(os.path.join(self.config.dest, self.config.log_dir, "log-" + self.backup_time + "-dest.csv"))
+        for file_path in file_paths:
+            if not os.path.isdir(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            if os.path.isfile(file_path) and not os.access(file_path, os.W_OK):
+                file_path = file_path[:-4] + "-1.csv"
+            mode = "a" if self._log_opened else "w"
+            try:
+                log_file = open(file_path, mode, newline="", encoding="utf-8", errors="backslashreplace")
+            except Exception:
+                file_path = file_path[:-4] + "-1.csv"
+                log_file = open(file_path, mode, newline="", encoding="utf-8", errors="backslashreplace")
+            self._log_files.append(log_file)
+            if file_path not in self._log_paths:
+                self._log_paths.append(file_path)
+        if self.config.history_index and self._history is None:
+            # rows are indexed by path as they are written to the log on source
+            self._history = HistoryIndex(os.path.dirname(self._log_files[0].name))
+            if not self._log_opened:
+                self._history.forgetLog(os.path.basename(self._log_files[0].name))
+        self._log_opened = True
+
+    def closeLogFiles(self) -> None:
+        for log_file in self._log_files:
+            log_file.close()
+        self._log_files = []
+        if self._history is not None:
+            self._history.close()
+            self._history = None
+
+    def renderRows(self, rows: list) -> str:
+        buffer = io.StringIO()
+        csv.writer(buffer, delimiter=",").writerows(rows)
+        return buffer.getvalue()
+
+    def flushRows(self) -> None:
+        # write pending rows (up to any held rows) to the log files and drop them from memory
+        end = len(self._log) if self._log_hold is None else self._log_hold - self._log_start
+        if end <= 0 or (self._log_start == 0 and end < 2):
+            return None
+        if not self._log_files:
+            self.openLogFiles()
+        rows, columns = self._log[:end], self._log_columns[:end]
+        if self._log_start == 0:
+            # reserve fixed width fields for the database CRCs in the settings row so they can be patched by writeLog
+            settings = rows[1].copy()
+            settings[5], settings[7] = settings[5].zfill(8), settings[7].zfill(8)
+            header = self.renderRows([rows[0]]).encode("utf-8", "backslashreplace")
+            self._log_crc_offsets = [len(header) + len(self.renderRows([settings[:k]]).encode("utf-8", "backslashreplace")) - 1 for k in [5, 7]]
+            rows = [rows[0], settings] + [self.formatRow(row) for row in rows[2:]]
+        else:
+            rows = [self.formatRow(row) for row in rows]
+        data = self.renderRows(rows)
+        for log_file in self._log_files:
+            log_file.write(data)
+        if self._history is not None:
+            self._log_files[0].flush()
+            self._history.ingestLog(self._log_files[0].name)
+        if self.config.write_log_summary:
+            for i in range(len(rows)):
+                if columns[i]:
+                    self.summarizeRow(rows[i], columns[i])
+        del self._log[:end]
+        del self._log_columns[:end]
+        self._log_start += end
+
+    def summarizeRow(self, entry: list, columns: list) -> None:
+        # add a log entry to the log summary, which combines multiple log entries into a single row
         # each row contains all relevant info of a single file across source, destination and databases on both sides
-        columns = ["Section",
-                   "Header", "Subheader", "Path", "Size", "Modified", "Hash",
-                   "Header", "Subheader", "Path", "Size", "Modified", "Hash",
-                   "Header", "Subheader", "Path", "Size", "Modified", "Hash",
-                   "Header", "Subheader", "Path", "Size", "Modified", "Hash"]
-        log_csv = [columns]
-        new_section = False
-        entry_number = 0
-        for i in range(len(self._log)):
-            if self._log_columns[i]:
-                if self._log_columns[i][-1] and not new_section:
-                    # create new row based on last value of log_columns (unless a new section was just started)
-                    log_csv.append([""]*len(columns))
-                    entry_number = -1
-                if self._log_columns[i][0] == "Section":
-                    # fill in the label for the new section
-                    log_csv[-1][0] = self._log[i][0].strip("# ")
-                    new_section = True
-                    entry_number = -1
-                else:
-                    new_entry = True
-                    for j in range(len(self._log[i])):
-                        # fill in row with items from entries under the correct column
-                        if self._log_columns[i][j]:
-                            if new_entry:
-                                entry_number += 1
-                                new_entry = False
-                                new_section = False
-                            entry_offset = columns.index(self._log_columns[i][j])
-                            log_csv[-1][entry_offset + entry_number*6] = self._log[i][j]
-                    if not log_csv[-1][0]:
-                        # copy the section from the above row if missing
-                        log_csv[-1][0] = log_csv[-2][0]
-        if all(entry == "" for entry in log_csv[-1][1:]):
-            _ = log_csv.pop(-1)
-        return log_csv
+        if columns[-1] and not self._summary_new_section:
+            # create new row based on last value of columns (unless a new section was just started), the previous row is complete
+            self._summary_prev_section = self._summary_row[0]
+            self.writeSummaryRows([self._summary_row], True)
+            self._summary_row = [""]*len(self._summary_columns)
+            self._summary_entry_number = -1
+        if columns[0] == "Section":
+            # fill in the label for the new section
+            self._summary_row[0] = entry[0].strip("# ")
+            self._summary_new_section = True
+            self._summary_entry_number = -1
+        else:
+            new_entry = True
+            for j in range(len(entry)):
+                # fill in row with items from entries under the correct column
+                if columns[j]:
+                    if new_entry:
+                        self._summary_entry_number += 1
+                        new_entry = False
+                        self._summary_new_section = False
+                    self._summary_row[self._summary_offsets[columns[j]] + self._summary_entry_number*6] = entry[j]
+            if not self._summary_row[0]:
+                # copy the section from the above row if missing
+                self._summary_row[0] = self._summary_prev_section
+
+    def writeSummaryRows(self, rows: list, complete: bool) -> None:
+        # <source>/.backupy/Logs/log-yymmdd-HHMM-plus.csv, rows that are not complete are overwritten by the next write
+        if self._summary_file is None:
+            file_path = os.path.join(self.config.source, self.config.log_dir, "log-" + self.backup_time + "-plus.csv")
+            if not os.path.isdir(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            self._summary_file = open(file_path, "r+b" if self._summary_opened else "wb")
+            self._summary_file.seek(self._summary_size)
+            self._summary_file.truncate()
+            self._summary_opened = True
+        data = self.renderRows(rows).encode("utf-8", "backslashreplace")
+        self._summary_file.write(data)
+        if complete:
+            self._summary_size += len(data)
+        else:
+            self._summary_file.close()
+            self._summary_file = None
 
     def writeLog(self, db_name: str) -> None:
+        if latency.enabled and not db_name.startswith("database.tmp"):
+            self.printLatencyReport()
         if not self.config.nolog:
             # <source|dest>/.backupy/database.json
             if self.config.dry_run:
                 db_name = db_name[:-4] + "dryrun.json"
             self.source.saveDatabase(db_name)
             self.dest.saveDatabase(db_name)
-            self._log[1][5] = self.source.calcCrc(os.path.join(self.source.dir, self.source.config_dir, db_name))
-            self._log[1][7] = self.dest.calcCrc(os.path.join(self.dest.dir, self.dest.config_dir, db_name))
-            # <source>/.backupy/Logs/log-yymmdd-HHMM.csv
-            if self.config.root_alias_log or self.config.force_posix_path_sep:
-                for i in range(2, len(self._log)):
-                    for j in range(len(self._log[i])):
-                        if type(self._log[i][j]) == str:
-                            if self.config.root_alias_log:
-                                self._log[i][j] = self._log[i][j].replace(self.config.source, getString("<source>"))
-                                self._log[i][j] = self._log[i][j].replace(self.config.dest, getString("<dest>"))
-                            if self.config.force_posix_path_sep:
-                                self._log[i][j] = self._log[i][j].replace(os.path.sep, "/")
-            writeCsv(os.path.join(self.config.source, self.config.log_dir, "log-" + self.backup_time + ".csv"), self._log)
-            if self.config.write_log_dest:
-                writeCsv(os.path.join(self.config.dest, self.config.log_dir, "log-" + self.backup_time + "-dest.csv"), self._log)
+            source_crc = self.source.calcCrc(os.path.join(self.source.dir, self.source.config_dir, db_name))
+            dest_crc = self.dest.calcCrc(os.path.join(self.dest.dir, self.dest.config_dir, db_name))
+            # write remaining rows, then patch the database CRCs into the settings row
+            self.flushRows()
+            if self._log_files:
+                for log_file in self._log_files:
+                    log_file.flush()
+                    with open(log_file.name, "r+b") as f:
+                        for offset, crc in zip(self._log_crc_offsets, [source_crc, dest_crc]):
+                            f.seek(offset)
+                            f.write(crc.zfill(8).encode())
+                self.closeLogFiles()
             if self.config.write_log_summary:
-                writeCsv(os.path.join(self.config.source, self.config.log_dir, "log-" + self.backup_time + "-plus.csv"), self.convertLog())
+                # the current row may still be added to, so it is rewritten next time
+                if all(entry == "" for entry in self._summary_row[1:]):
+                    self.writeSummaryRows([], False)
+                else:
+                    self.writeSummaryRows([self._summary_row], False)
+            # the log is only finished after the last write (database.tmp.json is written before prompting to continue)
+            if not db_name.startswith("database.tmp"):
+                self.finishLogFiles()
+
+    def finishLogFiles(self) -> None:
+        # compress the logs of this run with log_compression, then compact logs older than log_retention_days
+        summary_path = os.path.join(self.config.source, self.config.log_dir, "log-" + self.backup_time + "-plus.csv")
+        log_dirs = []
+        for file_path in self._log_paths + [summary_path]:
+            if os.path.isfile(file_path):
+                if self.config.log_compression:
+                    compressFile(file_path, self.config.log_compression)
+                if os.path.dirname(file_path) not in log_dirs:
+                    log_dirs.append(os.path.dirname(file_path))
+        if self.config.log_retention_days > 0:
+            for log_dir in log_dirs:
+                self.compactLogs(log_dir)
+
+    def compactLogs(self, log_dir: str) -> None:
+        # <log_dir>/logs-yymm.zip for each month of runs, and <log_dir>/logs-index.json with the archive of each log, logs of this run are kept as is
+        cutoff = time.time() - self.config.log_retention_days * 86400
+        archives = {}
+        for name in sorted(os.listdir(log_dir)):
+            log_name = name if name.endswith(".csv") else os.path.splitext(name)[0]
+            file_path = os.path.join(log_dir, name)
+            if log_name.startswith("log-") and log_name.endswith(".csv") and not log_name.startswith("log-" + self.backup_time):
+                if os.path.getmtime(file_path) < cutoff:
+                    archives.setdefault("logs-%s.zip" % (log_name[4:8]), []).append((log_name, file_path))
+        if not archives:
+            return None
+        compression = {"bz2": zipfile.ZIP_BZIP2, "xz": zipfile.ZIP_LZMA}.get(self.config.log_compression, zipfile.ZIP_DEFLATED)
+        index_path = os.path.join(log_dir, "logs-index.json")
+        index = readJson(index_path)
+        for archive_name in sorted(archives):
+            with zipfile.ZipFile(os.path.join(log_dir, archive_name), "a", compression) as archive:
+                archived = set(archive.namelist())
+                for log_name, file_path in archives[archive_name]:
+                    # a log and its compressed copy (left by an interrupted compression) are archived once
+                    if log_name not in archived:
+                        info = zipfile.ZipInfo(log_name, max((1980, 1, 1, 0, 0, 0), time.localtime(os.path.getmtime(file_path))[:6]))
+                        info.compress_type = compression
+                        archive.writestr(info, readCompressed(file_path))
+                        archived.add(log_name)
+                    index[log_name] = archive_name
+        # only remove logs once they are in an archive and the index
+        writeJson(index_path, index, sort_keys=True)
+        for archive_name in archives:
+            for _, file_path in archives[archive_name]:
+                FileOps.remove(file_path)
 
     def replaceSurrogates(self, string: str) -> str:
         return string.encode("utf-8", "surrogateescape").decode("utf-8", "replace")
@@ -154,10 +347,17 @@ class LogManager:
         else:
             return "{:<10}".format("%s B" % (size))
 
+    def prettyTime(self, mtime: float) -> str:
+        if mtime not in self._time_cache:
+            if len(self._time_cache) >= 65536:
+                self._time_cache.clear()
+            self._time_cache[mtime] = time.ctime(mtime)
+        return self._time_cache[mtime]
+
     def prettyAttr(self, attr: dict) -> list:
         attr_list = []
         attr_list.append(self.prettySize(attr["size"]).strip())
-        attr_list.append(time.ctime(attr["mtime"]))
+        attr_list.append(self.prettyTime(attr["mtime"]))
         if "crc" in attr:
             attr_list.append(attr["crc"])
         if "dir" in attr:
@@ -173,11 +373,16 @@ class LogManager:
     def printFileInfo(self, header: str, f: str, d: dict, sub_header: str = "", skip_info: bool = False) -> None:
         header, sub_header = getString(header), getString(sub_header)
         if f in d and d[f] is not None:
-            self.append([header.strip(), sub_header.strip(), f] + self.prettyAttr(d[f]), ["Header", "Subheader", "Path", "Size", "Modified", "Hash", ""], False)
+            # attributes are formatted when the row is written
+            attr = {key: d[f][key] for key in ["size", "mtime", "crc", "dir"] if key in d[f]}
+            self.append([header.strip(), sub_header.strip(), f, attr], ["Header", "Subheader", "Path", "Size", "Modified", "Hash", ""], False)
             missing = False
         else:
             self.append([header.strip(), sub_header.strip(), f] + [getString("Missing")], ["Header", "Subheader", "Path", "Size"], False)
             missing = True
+        # only format for the console if it will be printed
+        if not self.config.verbose:
+            return None
         if header == "":
             s = ""
         else:
@@ -189,13 +394,25 @@ class LogManager:
             s = s + extra_space + self.colourString(sub_header, "B") + " "*(12-len(sub_header))
             if not missing:
                 s = s + extra_space + self.colourString(getString(" Size: "), "B") + self.prettySize(d[f]["size"])
-                s = s + extra_space + self.colourString(getString(" Modified: "), "B") + time.ctime(d[f]["mtime"])
+                s = s + extra_space + self.colourString(getString(" Modified: "), "B") + self.prettyTime(d[f]["mtime"])
                 if "crc" in d[f]:
                     s = s + extra_space + self.colourString(getString(" Hash: "), "B") + d[f]["crc"]
             else:
                 s = s + extra_space + self.colourString(getString(" Missing"), "B")
-        if self.config.verbose:
-            print(s)
+        print(s)
+
+    def printLatencyReport(self) -> None:
+        # histogram and slowest paths of each operation type (latency_report)
+        self.append([getString("### SLOWEST OPERATIONS ###")])
+        for op, count, total, histogram, slowest in latency.getReport():
+            self.colourPrint(getString("%s: %s in %.3f s, slowest %.3f s") % (op, count, total, slowest[0][0] if slowest else 0), "B")
+            self.colourPrint("  " + ", ".join("%s: %s" % (bucket, n) for bucket, n in histogram.items()), "NONE")
+            self.append(["Histogram:", op, count, "%.6f" % (total)] + ["%s: %s" % (bucket, n) for bucket, n in histogram.items()])
+            for duration, path in slowest:
+                if self.config.verbose:
+                    self.colourPrint("  %.6f s  %s" % (duration, path), "NONE")
+                self.append(["Slowest:", op, path, "%.6f" % (duration)])
+        latency.close()
 
     def printFiles(self, files: list, d: dict) -> None:
         for f in files:
@@ -0,0 +1,99 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# https://github.com/elesiuta/backupy
+
+import itertools
+import os
+import sys
+import tracemalloc
+
+
+class MemoryProfiler:
+    def __init__(self, top_n: int = 10, sample_size: int = 1000):
+        """Snapshots of tracemalloc and the sizes of the main data structures at phase boundaries, tracemalloc is only started by open since tracing slows the run down"""
+        self.enabled = False
+        self.file_path = ""
+        self.top_n = top_n
+        self.sample_size = sample_size
+        self.reports = []
+
+    def open(self, file_path: str) -> None:
+        self.file_path = file_path
+        self.reports = []
+        self.enabled = True
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def close(self) -> None:
+        if self.enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.enabled = False
+
+    def entryBytes(self, entry, depth: int = 0) -> int:
+        # size of an entry and the objects it contains (two levels, enough for file attribute dicts and log rows)
+        size = sys.getsizeof(entry)
+        if depth < 2:
+            if isinstance(entry, dict):
+                size += sum(self.entryBytes(v, depth + 1) for v in entry.values())
+            elif isinstance(entry, (list, tuple, set)):
+                size += sum(self.entryBytes(v, depth + 1) for v in entry)
+        return size
+
+    def estimateBytes(self, structure) -> int:
+        """Size of a container and its entries, extrapolated from the first sample_size entries"""
+        if isinstance(structure, dict):
+            sample = [self.entryBytes(k) + self.entryBytes(v) for k, v in itertools.islice(structure.items(), self.sample_size)]
+        else:
+            sample = [self.entryBytes(e) for e in itertools.islice(structure, self.sample_size)]
+        if not sample:
+            return sys.getsizeof(structure)
+        return sys.getsizeof(structure) + sum(sample) * len(structure) // len(sample)
+
+    def snapshot(self, phase: str, structures: dict) -> None:
+        """Record traced memory, the top allocation sites, and the entries and estimated bytes of each structure (name: container)"""
+        if not self.enabled:
+            return None
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                                              tracemalloc.Filter(False, __file__),
+                                                              tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                                                              tracemalloc.Filter(False, "<unknown>")])
+        sites = [(str(stat.traceback), stat.size, stat.count) for stat in snapshot.statistics("lineno")[:self.top_n]]
+        sizes = [(name, len(structures[name]), self.estimateBytes(structures[name])) for name in structures]
+        self.reports.append((phase, current, peak, sizes, sites))
+
+    def write(self) -> None:
+        """Write the report of every snapshot to file_path then stop tracing"""
+        if not self.enabled:
+            return None
+        lines = []
+        for phase, current, peak, sizes, sites in self.reports:
+            lines.append("### %s ###" % (phase.upper()))
+            lines.append("traced memory: %.1f MB (peak %.1f MB)" % (current / 2**20, peak / 2**20))
+            lines.append("structures:")
+            for name, entries, estimate in sorted(sizes, key=lambda s: -s[2]):
+                lines.append("  %-32s %12s entries %12.1f MB" % (name, entries, estimate / 2**20))
+            lines.append("top allocation sites:")
+            for site, size, count in sites:
+                lines.append("  %12.1f MB %12s blocks  %s" % (size / 2**20, count, site))
+            lines.append("")
+        if os.path.dirname(self.file_path) and not os.path.isdir(os.path.dirname(self.file_path)):
+            os.makedirs(os.path.dirname(self.file_path))
+        with open(self.file_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines))
+        self.close()
+
+
+# one per process since tracemalloc is global, so close can stop the tracing a previous run in the same process started
+memprofile = MemoryProfiler()
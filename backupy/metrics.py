@@ -0,0 +1,122 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# https://github.com/elesiuta/backupy
+
+import os
+import threading
+import time
+import typing
+
+
+METRICS_HELP = {
+    "backupy_run_status": "Exit status of the last run (1 for the status label that applies)",
+    "backupy_run_timestamp_seconds": "Time the last run finished",
+    "backupy_phase_duration_seconds": "Duration of each phase of the run",
+    "backupy_files": "Files scanned, hashed, copied, moved, and removed",
+    "backupy_bytes": "Bytes scanned, hashed, copied, moved, and removed",
+    "backupy_errors": "File operations that failed",
+    "backupy_conflicts": "Database conflicts and CRC errors detected",
+    "backupy_transfer_files": "Files in each transfer list",
+    "backupy_transfer_bytes": "Bytes in each transfer list",
+    "backupy_database_seconds": "Time spent loading and saving databases",
+    "backupy_peak_memory_bytes": "Peak resident memory of the process",
+}
+
+
+class Metrics:
+    def __init__(self):
+        """Counters collected during a run and written in the Prometheus text format, only counted once open is given a metrics_file to write"""
+        self.enabled = False
+        self.file_path = ""
+        self.lock = threading.Lock()
+        self.values = {}
+        self.phase_start = {}
+
+    def open(self, file_path: str) -> None:
+        self.file_path = file_path
+        self.values, self.phase_start = {}, {}
+        self.enabled = True
+
+    def close(self) -> None:
+        self.enabled = False
+
+    def add(self, name: str, value: float = 1, **labels) -> None:
+        if self.enabled:
+            key = tuple(sorted(labels.items()))
+            with self.lock:
+                series = self.values.setdefault(name, {})
+                series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        if self.enabled:
+            with self.lock:
+                self.values.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def phaseStart(self, phase: str) -> None:
+        if self.enabled:
+            self.phase_start[phase] = time.monotonic()
+
+    def phaseEnd(self, phase: str) -> None:
+        if self.enabled:
+            self.add("backupy_phase_duration_seconds", time.monotonic() - self.phase_start.pop(phase, time.monotonic()), phase=phase)
+
+    def operation(self, op: str, size: typing.Union[int, None], error: typing.Union[str, None] = None) -> None:
+        if self.enabled:
+            if error is None:
+                self.add("backupy_files", 1, op=op)
+                self.add("backupy_bytes", size or 0, op=op)
+            else:
+                self.add("backupy_errors", 1, op=op)
+
+    def peakMemory(self) -> int:
+        try:
+            import resource
+            import sys
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # kilobytes on Linux, bytes on macOS
+            return peak if sys.platform == "darwin" else peak * 1024
+        except Exception:
+            return 0
+
+    def escape(self, value: str) -> str:
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    def write(self, status: str, job_labels: dict) -> None:
+        """Write all metrics labelled with job_labels (node_exporter textfile collector format), replacing the file atomically"""
+        if not self.enabled:
+            return None
+        self.set("backupy_run_status", 1, status=status)
+        self.set("backupy_run_timestamp_seconds", round(time.time(), 3))
+        peak_memory = self.peakMemory()
+        if peak_memory:
+            self.set("backupy_peak_memory_bytes", peak_memory)
+        lines = []
+        for name in METRICS_HELP:
+            if name not in self.values:
+                continue
+            lines.append("# HELP %s %s" % (name, METRICS_HELP[name]))
+            lines.append("# TYPE %s gauge" % (name))
+            for key in sorted(self.values[name]):
+                labels = ",".join('%s="%s"' % (k, self.escape(v)) for k, v in sorted(job_labels.items()) + list(key))
+                value = self.values[name][key]
+                lines.append("%s{%s} %s" % (name, labels, round(value, 6) if isinstance(value, float) else value))
+        if os.path.dirname(self.file_path) and not os.path.isdir(os.path.dirname(self.file_path)):
+            os.makedirs(os.path.dirname(self.file_path))
+        with open(self.file_path + ".tmp", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(self.file_path + ".tmp", self.file_path)
+
+
+# module level so FileScanner can count hashed files without a reference to the run, reset at the start of each run and written with the transfer lists at the end
+metrics = Metrics()
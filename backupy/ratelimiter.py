@@ -0,0 +1,175 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# https://github.com/elesiuta/backupy
+
+import os
+import platform
+import shutil
+import signal
+import threading
+import time
+
+from .utils import FileOps, getString, readJson
+
+
+class TokenBucket:
+    def __init__(self, rate: int):
+        """Allows rate units per second on average, with bursts up to one second, 0 for unlimited"""
+        self.rate = rate
+        self.tokens = float(rate)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: int) -> None:
+        if self.rate <= 0:
+            return None
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(float(self.rate), self.tokens + (now - self.last) * self.rate) - amount
+            self.last = now
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThrottledReader:
+    def __init__(self, f, limiter: 'RateLimiter'):
+        """File object wrapper for FileOps.open that consumes tokens for each read"""
+        self.f = f
+        self.limiter = limiter
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.f.read(size)
+        self.limiter.consumeRead(len(data))
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.limiter.chunk_size), b"")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+    def __getattr__(self, attr):
+        return getattr(self.f, attr)
+
+
+class ThrottledWriter:
+    def __init__(self, f, limiter: 'RateLimiter'):
+        """File object wrapper for FileOps.openw that consumes tokens for each write"""
+        self.f = f
+        self.limiter = limiter
+
+    def write(self, data: bytes) -> int:
+        self.limiter.consumeWrite(len(data))
+        return self.f.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+    def __getattr__(self, attr):
+        return getattr(self.f, attr)
+
+
+class RateLimiter:
+    def __init__(self, read_bps: int, write_bps: int, iops: int, limits_file: str = ""):
+        """Token bucket limits for reads, writes, and IO operations shared across all FileOps data paths (copy, resume, patch, compress, CRC, and verify)"""
+        self.read = TokenBucket(read_bps)
+        self.write = TokenBucket(write_bps)
+        self.iops = TokenBucket(iops)
+        self.chunk_size = 1048576
+        self.limits_file = limits_file
+        self.originals = {}
+
+    def setLimits(self, read_bps: int, write_bps: int, iops: int) -> None:
+        self.read.rate, self.write.rate, self.iops.rate = read_bps, write_bps, iops
+        # smaller chunks keep the rate smooth for low limits
+        self.chunk_size = max(4096, min([1048576] + [rate // 4 for rate in [read_bps, write_bps] if rate > 0]))
+
+    def reload(self, *args) -> None:
+        """Reload limits from limits_file (installed as the SIGHUP handler), keys are the same as in the config"""
+        try:
+            limits = readJson(self.limits_file)
+            self.setLimits(int(limits.get("limit_read_bps", self.read.rate)),
+                           int(limits.get("limit_write_bps", self.write.rate)),
+                           int(limits.get("limit_iops", self.iops.rate)))
+            print(getString("Reloaded IO limits from: %s") % (self.limits_file))
+        except Exception as e:
+            print(getString("Could not reload IO limits: %s") % (str(e)))
+
+    def consumeRead(self, amount: int) -> None:
+        self.iops.consume(1)
+        self.read.consume(amount)
+
+    def consumeWrite(self, amount: int) -> None:
+        self.iops.consume(1)
+        self.write.consume(amount)
+
+    def copy(self, source: str, dest: str, follow_symlinks: bool = True) -> None:
+        """Throttled replacement for shutil.copy2"""
+        if not follow_symlinks and os.path.islink(source):
+            shutil.copy2(source, dest, follow_symlinks=False)
+            return None
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(source))
+        with ThrottledReader(open(source, "rb"), self) as f_source, ThrottledWriter(open(dest, "wb"), self) as f_dest:
+            for chunk in f_source:
+                f_dest.write(chunk)
+        shutil.copystat(source, dest)
+
+    def install(self) -> None:
+        """Monkey-patch FileOps so all data reads and writes go through the limiter (clone falls back to copy, the others use open and openw)"""
+        self.setLimits(self.read.rate, self.write.rate, self.iops.rate)
+        self.originals = {attr: getattr(FileOps, attr) for attr in ["open", "openw", "copy", "copyff"]}
+        FileOps.open = lambda path: ThrottledReader(open(path, "rb"), self)
+        FileOps.openw = lambda path, mode="wb": ThrottledWriter(open(path, mode), self)
+        FileOps.copy = self.copy
+        FileOps.copyff = lambda source, dest: self.copy(source, dest, follow_symlinks=False)
+        if self.limits_file and hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+            self.originals["SIGHUP"] = signal.signal(signal.SIGHUP, self.reload) or signal.SIG_DFL
+
+    def uninstall(self) -> None:
+        """Restore FileOps (shared by the whole process) so later jobs are not throttled with these limits"""
+        handler = self.originals.pop("SIGHUP", None)
+        if handler is not None:
+            signal.signal(signal.SIGHUP, handler)
+        for attr, func in self.originals.items():
+            setattr(FileOps, attr, func)
+        self.originals = {}
+
+
+def setIoPriority(io_priority: str) -> bool:
+    """Set the IO scheduling class of this process ("idle" or "best-effort" at the lowest level), returns success"""
+    if io_priority == "":
+        return True
+    try:
+        if platform.system() == "Linux":
+            import ctypes
+            # ioprio_set(IOPRIO_WHO_PROCESS, 0, class << IOPRIO_CLASS_SHIFT | data)
+            syscalls = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314, "ppc64le": 273}
+            ioprio = {"idle": 3 << 13, "best-effort": 2 << 13 | 7}[io_priority]
+            libc = ctypes.CDLL(None, use_errno=True)
+            return libc.syscall(syscalls[platform.machine()], 1, 0, ioprio) == 0
+        elif hasattr(os, "nice"):
+            # closest approximation elsewhere, also lowers CPU priority
+            os.nice(19 if io_priority == "idle" else 10)
+            return True
+    except Exception:
+        pass
+    return False
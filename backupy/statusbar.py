@@ -14,54 +14,81 @@
 # https://github.com/elesiuta/backupy
 
 import shutil
+import time
 
-from .utils import getString, getStringMaxWidth
+from .events import events
+from .utils import getString, getStringMaxWidth, truncateStringWidth
 
 
 class StatusBar:
-    def __init__(self, title: str, total: int, display: bool, gui: bool = False):
+    # repaints per second, counters are always updated and the last state is shown by endProgress (set from stdout_status_bar_rate by BackupManager)
+    refresh_rate = 10
+
+    def __init__(self, title: str, total: int, display: bool, gui: bool = False, total_bytes: int = 0):
         self.title = title
         self.total = total
         self.display = display
         self.gui = gui
+        # progress by bytes with throughput and ETA if total_bytes is known (each file is counted once the next one starts)
+        self.total_bytes = total_bytes
+        self.bytes_done = 0
+        self.bytes_pending = 0
+        self.start_time = time.monotonic()
+        self.progress = 0
+        self.refresh_interval = 1 / self.refresh_rate if self.refresh_rate > 0 else 0
+        self.last_paint = self.start_time
         terminal_width = shutil.get_terminal_size()[0]
         if terminal_width < 16:
             self.display = False
         if self.display:
             self.char_display = terminal_width - 2
-            self.progress = 0
-            if self.total == -1:
-                progress_str = str(self.progress) + ": "
-            else:
-                self.digits = str(len(str(self.total)))
-                progress_str = str("{:>" + self.digits + "}").format(self.progress) + "/" + str(self.total) + ": "
+            self.digits = str(len(str(self.total)))
+            progress_str = self.progressString()
             self.title_str = getString(self.title) + " "
             self.msg_len = self.char_display - len(progress_str) - len(self.title_str)
             msg = " " * self.msg_len
             print(self.title_str + progress_str + msg, end="\r")
         elif self.gui and self.total > 0:
-            self.progress = 0
             print("progress: %s/%s" % (self.progress, self.total))
 
-    def update(self, msg: str) -> None:
+    def progressString(self) -> str:
+        if self.total == -1:
+            return str(self.progress) + ": "
+        progress_str = str("{:>" + self.digits + "}").format(self.progress) + "/" + str(self.total)
+        if self.total_bytes > 0:
+            elapsed = time.monotonic() - self.start_time
+            rate = self.bytes_done / elapsed if elapsed > 0 else 0
+            progress_str += " %3d%% %.1f MB/s" % (100 * self.bytes_done // self.total_bytes, rate / 10**6)
+            if rate > 0:
+                eta = int((self.total_bytes - self.bytes_done) / rate)
+                progress_str += " ETA %d:%02d:%02d" % (eta // 3600, eta // 60 % 60, eta % 60)
+            else:
+                progress_str += " ETA -:--:--"
+        return progress_str + ": "
+
+    def update(self, msg: str, size: int = 0) -> None:
+        self.progress += 1
+        self.bytes_done += self.bytes_pending
+        self.bytes_pending = size
+        events.progress(self.title, self.progress, self.total, self.bytes_done, self.total_bytes)
+        if not (self.display or self.gui):
+            return None
+        now = time.monotonic()
+        if now - self.last_paint < self.refresh_interval:
+            return None
+        self.last_paint = now
         if self.display:
-            self.progress += 1
             msg = msg.encode("utf-8", "surrogateescape").decode("utf-8", "replace")
-            if self.total == -1:
-                progress_str = str(self.progress) + ": "
-            else:
-                progress_str = str("{:>" + self.digits + "}").format(self.progress) + "/" + str(self.total) + ": "
+            progress_str = self.progressString()
             self.msg_len = self.char_display - len(progress_str) - len(self.title_str)
-            while getStringMaxWidth(msg) > self.msg_len:
-                splice = (len(msg) - 4) // 2
-                msg = msg[:splice] + "..." + msg[-splice:]
+            msg = truncateStringWidth(msg, self.msg_len)
             msg = msg + " " * int(self.msg_len - getStringMaxWidth(msg))
             print(self.title_str + progress_str + msg, end="\r")
         elif self.gui and self.total > 0:
-            self.progress += 1
             print("progress: %s/%s" % (self.progress, self.total))
 
     def endProgress(self) -> None:
+        events.progress(self.title, self.progress, self.total, self.bytes_done + self.bytes_pending, self.total_bytes, force=True)
         if self.display:
             if self.title == "Copying":
                 title_str = getString("File operations completed!")
@@ -15,7 +15,7 @@
 
 from .filescanner import FileScanner
 from .logman import LogManager
-from .utils import getString
+from .utils import getString, getVersion, writeJson
 
 
 class TransferLists:
@@ -77,6 +77,33 @@ class TransferLists:
         self.changed = list(self.changed)
         self.moved = list(self.moved)
 
+    def exportPlan(self, file_path: str, source: FileScanner, dest: FileScanner, settings: dict) -> None:
+        """Write the transfer lists and attributes of the files in them to file_path, so they can be applied later without scanning"""
+        source_dict, _ = source.getDicts()
+        dest_dict, _ = dest.getDicts()
+        source_files = set(self.source_only) | set(self.changed) | set(self.dest_deleted) | set([f["source"] for f in self.moved])
+        dest_files = set(self.dest_only) | set(self.changed) | set(self.source_deleted) | set([f["dest"] for f in self.moved])
+        plan = {"version": getVersion(),
+                "settings": settings,
+                "lists": {"source_only": list(self.source_only),
+                          "dest_only": list(self.dest_only),
+                          "changed": list(self.changed),
+                          "moved": list(self.moved),
+                          "source_deleted": list(self.source_deleted),
+                          "dest_deleted": list(self.dest_deleted)},
+                "source_files": {f: source_dict[f] for f in sorted(source_files)},
+                "dest_files": {f: dest_dict[f] for f in sorted(dest_files)}}
+        writeJson(file_path, plan)
+
+    def importPlan(self, plan: dict) -> None:
+        """Replace the transfer lists with those from a plan written by exportPlan"""
+        self.source_only = plan["lists"]["source_only"]
+        self.dest_only = plan["lists"]["dest_only"]
+        self.changed = plan["lists"]["changed"]
+        self.moved = plan["lists"]["moved"]
+        self.source_deleted = plan["lists"]["source_deleted"]
+        self.dest_deleted = plan["lists"]["dest_deleted"]
+
     def skipFileTransfers(self, log: LogManager) -> bool:
         self._unfreeze()
         assert isinstance(self.source_only, list) and isinstance(self.dest_only, list) and isinstance(self.changed, list)
@@ -13,12 +13,17 @@
 
 # https://github.com/elesiuta/backupy
 
-import csv
+import bz2
+import gzip
 import json
+import lzma
 import os
 import shutil
+import struct
+import tempfile
 import typing
 import unicodedata
+import zlib
 
 
 def getVersion() -> str:
@@ -32,14 +37,45 @@ def getString(text: str) -> str:
     return text
 
 
+def getCharMaxWidth(char: str) -> int:
+    if unicodedata.east_asian_width(char) in ["W", "F", "A"]:
+        return 2
+    return 1
+
+
 def getStringMaxWidth(string: str) -> int:
-    width = 0
-    for char in string:
-        if unicodedata.east_asian_width(char) in ["W", "F", "A"]:
-            width += 2
-        else:
-            width += 1
-    return width
+    # isascii is a flag check, every ascii character has a width of 1
+    if string.isascii():
+        return len(string)
+    return sum(getCharMaxWidth(char) for char in string)
+
+
+def truncateStringWidth(string: str, width: int) -> str:
+    # shorten string to at most width by replacing the middle with "...", keeping as much of both ends as fits
+    if string.isascii():
+        if len(string) <= width:
+            return string
+        if width < 3:
+            return string[:max(width, 0)]
+        head = (width - 3 + 1) // 2
+        tail = width - 3 - head
+        return string[:head] + "..." + (string[-tail:] if tail > 0 else "")
+    widths = [getCharMaxWidth(char) for char in string]
+    if sum(widths) <= width:
+        return string
+    if width < 3:
+        return ""
+    budget = width - 3
+    head_budget = (budget + 1) // 2
+    head, used = 0, 0
+    while head < len(widths) and used + widths[head] <= head_budget:
+        used += widths[head]
+        head += 1
+    tail, tail_budget = 0, budget - used
+    while tail < len(widths) - head and widths[-tail - 1] <= tail_budget:
+        tail_budget -= widths[-tail - 1]
+        tail += 1
+    return string[:head] + "..." + (string[-tail:] if tail > 0 else "")
 
 
 def simplePrompt(options: list) -> str:
@@ -50,22 +86,6 @@ def simplePrompt(options: list) -> str:
                 return option
 
 
-def writeCsv(file_path: str, data: list) -> None:
-    if not os.path.isdir(os.path.dirname(file_path)):
-        os.makedirs(os.path.dirname(file_path))
-    if os.path.isfile(file_path) and not os.access(file_path, os.W_OK):
-        file_path = file_path[:-4] + "-1.csv"
-    try:
-        with open(file_path, "w", newline="", encoding="utf-8", errors="backslashreplace") as f:
-            writer = csv.writer(f, delimiter=",")
-            writer.writerows(data)
-    except Exception:
-        file_path = file_path[:-4] + "-1.csv"
-        with open(file_path, "w", newline="", encoding="utf-8", errors="backslashreplace") as f:
-            writer = csv.writer(f, delimiter=",")
-            writer.writerows(data)
-
-
 def readJson(file_path: str) -> dict:
     if os.path.exists(file_path):
         with open(file_path, "r", encoding="utf-8", errors="surrogateescape") as json_file:
@@ -84,6 +104,171 @@ def writeJson(file_path: str, data: dict, subdir: bool = True, sort_keys: bool =
         print(getString("Error, could not write: ") + file_path)
 
 
+def resumableCopy(source: str, dest: str, part_path: str, checkpoint_bytes: int, verify: bool) -> None:
+    # copy source to part_path, recording the offset and CRC of the copied prefix in a sidecar at each checkpoint so an interrupted copy can resume, then rename into place
+    stat = os.stat(source)
+    sidecar_path = part_path + ".json"
+    progress = readJson(sidecar_path)
+    offset, crc = 0, 0
+    if (progress.get("source") == source and progress.get("size") == stat.st_size and progress.get("mtime") == stat.st_mtime and
+            os.path.isfile(part_path) and os.path.getsize(part_path) >= progress.get("offset", 0)):
+        offset, crc = progress["offset"], progress["crc"]
+        if verify:
+            prefix_crc, remaining = 0, offset
+            with FileOps.open(part_path) as f:
+                for chunk in iter(lambda: f.read(min(1048576, remaining)), b""):
+                    prefix_crc = zlib.crc32(chunk, prefix_crc)
+                    remaining -= len(chunk)
+            if remaining or prefix_crc != crc:
+                offset, crc = 0, 0
+    if not os.path.isdir(os.path.dirname(part_path)):
+        os.makedirs(os.path.dirname(part_path))
+    with FileOps.open(source) as f_source, FileOps.openw(part_path, "r+b" if offset else "wb") as f_dest:
+        f_source.seek(offset)
+        f_dest.seek(offset)
+        f_dest.truncate(offset)
+        last_checkpoint = offset
+        for chunk in iter(lambda: f_source.read(1048576), b""):
+            f_dest.write(chunk)
+            crc = zlib.crc32(chunk, crc)
+            offset += len(chunk)
+            if offset - last_checkpoint >= checkpoint_bytes:
+                # data must be on disk before the checkpoint claims it
+                f_dest.flush()
+                os.fsync(f_dest.fileno())
+                writeJson(sidecar_path, {"source": source, "size": stat.st_size, "mtime": stat.st_mtime, "offset": offset, "crc": crc})
+                last_checkpoint = offset
+    shutil.copystat(source, part_path)
+    os.replace(part_path, dest)
+    if os.path.exists(sidecar_path):
+        os.remove(sidecar_path)
+
+
+def syncFiles(root_paths: list, file_paths: list) -> list:
+    # flush written data to disk for a batch of files, one syncfs per filesystem if available, otherwise an fsync of each file (never a global sync of every filesystem)
+    # returns a list of (file_path, error) for files that could not be synced, so one file does not stop the rest of the batch
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        for root_path in root_paths:
+            fd = os.open(root_path, os.O_RDONLY)
+            try:
+                if libc.syncfs(fd) != 0:
+                    raise OSError(ctypes.get_errno(), "syncfs failed")
+            finally:
+                os.close(fd)
+        return []
+    except Exception:
+        pass
+    errors = []
+    for file_path in file_paths:
+        # symlinks have no data of their own, and copies can be read only
+        if os.path.islink(file_path):
+            continue
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            errors.append((file_path, str(e)))
+    return errors
+
+
+def getLayoutKey(file_path: str, use_extents: bool = True) -> tuple:
+    # sort key for reading files in their physical order on disk: (device, first extent) via FIEMAP if available, otherwise (device, inode)
+    try:
+        stat = os.stat(file_path)
+    except Exception:
+        return (0, 2, 0)
+    if use_extents:
+        try:
+            import fcntl
+            # struct fiemap requesting a single extent, followed by space for one struct fiemap_extent
+            request = bytearray(struct.pack("=QQIIII", 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(56))
+            with open(file_path, "rb") as f:
+                fcntl.ioctl(f.fileno(), 0xC020660B, request, True)  # FS_IOC_FIEMAP
+            if struct.unpack_from("=I", request, 20)[0] > 0:
+                return (stat.st_dev, 0, struct.unpack_from("=Q", request, 40)[0])
+        except Exception:
+            pass
+    return (stat.st_dev, 1, stat.st_ino)
+
+
+def cloneFile(source: str, dest: str) -> None:
+    # try a copy-on-write clone (reflink) first, fallback to a regular copy
+    try:
+        import fcntl
+        with open(source, "rb") as f_source, open(dest, "wb") as f_dest:
+            fcntl.ioctl(f_dest.fileno(), 0x40049409, f_source.fileno())  # FICLONE
+        shutil.copystat(source, dest)
+    except Exception:
+        FileOps.copy(source, dest)
+
+
+def patchFile(source: str, dest: str, dest_blocks: list, block_size: int) -> tuple:
+    # write only the blocks of source that differ from dest_blocks into dest, returns (source_blocks, source_crc)
+    source_blocks = []
+    crc = 0
+    with FileOps.open(source) as f_source, FileOps.openw(dest, "r+b") as f_dest:
+        while True:
+            block = f_source.read(block_size)
+            if not block:
+                break
+            crc = zlib.crc32(block, crc)
+            block_crc = "%X" % (zlib.crc32(block) & 0xFFFFFFFF)
+            i = len(source_blocks)
+            if i >= len(dest_blocks) or dest_blocks[i] != block_crc:
+                f_dest.seek(i * block_size)
+                f_dest.write(block)
+            source_blocks.append(block_crc)
+        f_dest.truncate(f_source.tell())
+    shutil.copystat(source, dest)
+    return source_blocks, "%X" % (crc & 0xFFFFFFFF)
+
+
+def compressFile(file_path: str, compression: str) -> dict:
+    # replace file_path with a compressed copy, returns the compressed path and attributes of the original
+    # the copy is written to a temp file then renamed to the first name that does not exist yet (name.ext, name.1.ext, ...), existing files are never replaced
+    compressors = {"gzip": (gzip.open, ".gz"), "bz2": (bz2.open, ".bz2"), "xz": (lzma.open, ".xz")}
+    compressor, ext = compressors[compression]
+    stat = os.stat(file_path)
+    crc = 0
+    fd, temp_path = tempfile.mkstemp(prefix=".%s." % (os.path.basename(file_path)), suffix=ext + ".tmp", dir=os.path.dirname(file_path))
+    os.close(fd)
+    try:
+        with FileOps.open(file_path) as f_source, FileOps.openw(temp_path) as f_temp, compressor(f_temp, "wb") as f_dest:
+            for chunk in iter(lambda: f_source.read(1048576), b""):
+                crc = zlib.crc32(chunk, crc)
+                f_dest.write(chunk)
+        shutil.copystat(file_path, temp_path)
+        target, i = file_path + ext, 0
+        while True:
+            try:
+                # reserve the name (exclusive create is atomic) then replace it with the temp file
+                with open(target, "xb"):
+                    break
+            except FileExistsError:
+                i += 1
+                target = "%s.%s%s" % (file_path, i, ext)
+        os.replace(temp_path, target)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.remove(file_path)
+    return {"compressed": os.path.basename(target), "size": stat.st_size, "mtime": stat.st_mtime, "crc": "%X" % (crc & 0xFFFFFFFF)}
+
+
+def readCompressed(file_path: str) -> bytes:
+    # read the contents of a file compressed by compressFile (or an uncompressed file)
+    decompressors = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+    opener = decompressors.get(os.path.splitext(file_path)[1], open)
+    with opener(file_path, "rb") as f:
+        return f.read()
+
+
 class FileOps:
     """expose file operation functions as class attributes for easy monkey-patching"""
     # functions for readonly operations (used in BackupManager, FileManager, or FileScanner)
@@ -98,13 +283,21 @@ class FileOps:
     walk: typing.Callable = os.walk
     # functions for read/write operations (only used in FileManager)
     chmod: typing.Callable = os.chmod
+    clone: typing.Callable = cloneFile
+    compress: typing.Callable = compressFile
     copy: typing.Callable = shutil.copy2
     copyff: typing.Callable = lambda source, dest: shutil.copy2(source, dest, follow_symlinks=False)
+    link: typing.Callable = lambda source, dest: os.link(source, dest, follow_symlinks=False)
     makedirs: typing.Callable = os.makedirs
     move: typing.Callable = shutil.move
+    openw: typing.Callable = lambda path, mode="wb": open(path, mode)
+    patch: typing.Callable = patchFile
+    resume: typing.Callable = resumableCopy
     remove: typing.Callable = os.remove
     removedirs: typing.Callable = os.removedirs
+    replace: typing.Callable = os.replace
     rmdir: typing.Callable = os.rmdir
+    sync: typing.Callable = syncFiles
 
 
 def testConsistency(source_dicts: tuple, source_sets: tuple,
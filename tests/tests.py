@@ -5,7 +5,10 @@ import zlib
 import zipfile
 import time
 import csv
+import errno
+import gzip
 import json
+import subprocess
 import typing
 import sys
 
@@ -21,6 +24,7 @@ path = os.path.abspath(__file__)
 path = os.path.dirname(os.path.dirname(path))
 sys.path.insert(0, path)
 import backupy
+import backupy.cli
 os.chdir(path)
 
 def crc(fileName, prev = 0):
@@ -210,7 +214,7 @@ def setupTestDir(test_name, test_zip):
 def cleanupTestDir(test_name):
     shutil.rmtree(test_name)
 
-def runTest(test_name, config, set=0, rewrite_log=True, rewrite_sep=True, compare=True, setup=True, cleanup=True, write_solution=False):
+def runTest(test_name, config, set=0, rewrite_log=True, rewrite_sep=True, compare=True, setup=True, cleanup=True, write_solution=False, solution=None):
     # init dirs
     if setup:
         print("####### TEST: " + test_name + " #######")
@@ -223,7 +227,7 @@ def runTest(test_name, config, set=0, rewrite_log=True, rewrite_sep=True, compar
         dir_B = "dir B"
     dir_A_path = os.path.join(test_name, dir_A)
     dir_B_path = os.path.join(test_name, dir_B)
-    sol_path = os.path.join("tests", "test_solutions", test_name)
+    sol_path = os.path.join("tests", "test_solutions", solution if solution else test_name)
     dir_A_sol_path = os.path.join(sol_path, dir_A)
     dir_B_sol_path = os.path.join(sol_path, dir_B)
     # fix separators for running tests on windows and linux (should just recreate them all with posix separators and line endings at some point)
@@ -306,6 +310,96 @@ def runTest(test_name, config, set=0, rewrite_log=True, rewrite_sep=True, compar
     if compare:
         return dirA_stats, dirB_stats, dirAsol_stats, dirBsol_stats, compDict
 
+def fakeRsync(corrupt_first=False, missing=False, delay=0):
+    # stand-ins for subprocess.Popen and subprocess.run running rsync, copies with shutil (corrupting the first file of a batch, return code 23) or fails to start, reporting each file after delay seconds
+    class Popen:
+        def __init__(self, args, stdin, stdout, stderr, **kwargs):
+            if missing:
+                raise FileNotFoundError(2, "No such file or directory", "rsync")
+            source_root, dest_root = args[-2], args[-1]
+            self.stdout, self.returncode = [], 0
+            for f in os.fsdecode(stdin.read()).split("\0"):
+                if os.path.isdir(os.path.join(source_root, f)):
+                    os.makedirs(os.path.join(dest_root, f), exist_ok=True)
+                else:
+                    os.makedirs(os.path.dirname(os.path.join(dest_root, f)), exist_ok=True)
+                    shutil.copy2(os.path.join(source_root, f), os.path.join(dest_root, f))
+                    if corrupt_first and not self.returncode:
+                        with open(os.path.join(dest_root, f), "r+b") as fp:
+                            byte = fp.read(1)
+                            fp.seek(0)
+                            fp.write(bytes([byte[0] ^ 1]))
+                        self.returncode = 23
+                        stderr.write("rsync error: some files/attrs were not transferred (see previous errors) (code 23)\n")
+                self.stdout.append(f + "\n")
+            self.stdout = (time.sleep(delay) or line for line in self.stdout)
+        def wait(self):
+            return self.returncode
+    def run(args, **kwargs):
+        if missing:
+            raise FileNotFoundError(2, "No such file or directory", "rsync")
+        shutil.copy2(args[-2], args[-1])
+        return subprocess.CompletedProcess(args, 0, "", "")
+    return Popen, run
+
+def runRsyncTest(test_name, config, corrupt_first=False, missing=False, delay=0, **kwargs):
+    # runTest with fakeRsync, restoring subprocess and FileOps.copy (replaced by --rsync) after
+    popen, run, copy = subprocess.Popen, subprocess.run, backupy.utils.FileOps.copy
+    subprocess.Popen, subprocess.run = fakeRsync(corrupt_first, missing, delay)
+    try:
+        return runTest(test_name, config, **kwargs)
+    finally:
+        subprocess.Popen, subprocess.run, backupy.utils.FileOps.copy = popen, run, copy
+
+def readLogRows(test_name, log_dir=".backupy/Logs"):
+    with open(os.path.join(test_name, "dir A", log_dir, "log-000000-0000.csv"), "r", encoding="utf-8") as f:
+        return list(csv.reader(f))
+
+def runCrashTest(test_name, config, crash_file):
+    # sync a.txt, c.txt, d.txt, and s.txt, then delete s.txt from A and d.txt from B, modify c.txt on both, add n1.txt and n2.txt to A
+    dir_A, dir_B = os.path.join(test_name, "dir A"), os.path.join(test_name, "dir B")
+    shutil.rmtree(test_name, ignore_errors=True)
+    for d in [dir_A, dir_B]:
+        os.makedirs(d)
+        for f in ["a.txt", "c.txt", "d.txt", "s.txt"]:
+            with open(os.path.join(d, f), "w") as fp:
+                fp.write(f)
+    config = dict(config, source=dir_A, dest=dir_B)
+    backupy.backupman.BackupManager(dict(config)).run()
+    os.remove(os.path.join(dir_A, "s.txt"))
+    os.remove(os.path.join(dir_B, "d.txt"))
+    for d, data in [(dir_A, "modified on A"), (dir_B, "modified on B too")]:
+        with open(os.path.join(d, "c.txt"), "w") as fp:
+            fp.write(data)
+    for f in ["n1.txt", "n2.txt"]:
+        with open(os.path.join(dir_A, f), "w") as fp:
+            fp.write(f)
+    # crash when crash_file is removed or copied
+    remove, copy = backupy.utils.FileOps.remove, backupy.utils.FileOps.copy
+    def crashingRemove(path):
+        if os.path.basename(path) == crash_file:
+            raise KeyboardInterrupt()
+        remove(path)
+    def crashingCopy(source, dest):
+        if os.path.basename(dest) == crash_file:
+            raise KeyboardInterrupt()
+        copy(source, dest)
+    backupy.utils.FileOps.remove, backupy.utils.FileOps.copy = crashingRemove, crashingCopy
+    try:
+        backupy.backupman.BackupManager(dict(config)).run()
+        raise Exception("Run did not crash")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        backupy.utils.FileOps.remove, backupy.utils.FileOps.copy = remove, copy
+    # returns whether the journal of A still exists and the scanned sides and transfer lists of the next run
+    journal_exists = os.path.exists(os.path.join(dir_A, ".backupy", "journal.jsonl"))
+    backup_man = backupy.backupman.BackupManager(dict(config, dry_run=True))
+    backup_man._scanDirectories()
+    transfer_lists = backup_man._compareDirectories()
+    cleanupTestDir(test_name)
+    return journal_exists, backup_man.source, backup_man.dest, transfer_lists
+
 class TestBackupy(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -326,6 +420,128 @@ class TestBackupy(unittest.TestCase):
         self.assertEqual(dirA, dirAsol, str(compDict))
         self.assertEqual(dirB, dirBsol, str(compDict))
 
+    def test_mirror_new_events(self):
+        test_name = "mirror-new-events"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "new", "nomoves": True, "noprompt": True, "nolog": True, "noarchive": True, "event_stream": os.path.join(test_name, "events.jsonl")}
+        dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, cleanup=False, solution="mirror-new")
+        with open(os.path.join(test_name, "events.jsonl"), "r") as f:
+            events = [json.loads(line) for line in f]
+        cleanupTestDir(test_name)
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+        self.assertEqual([e["phase"] for e in events if e["event"] == "phase_end"], ["scan", "compare", "transfer"])
+        operations = [e for e in events if e["event"] == "operation"]
+        self.assertTrue(operations and all(e["ok"] for e in operations))
+        self.assertEqual(events[-1]["event"], "summary")
+        self.assertEqual(events[-1]["status"], "completed")
+        self.assertEqual(events[-1]["operations"]["copy"]["ok"], events[-1]["categories"]["source_only"]["count"] + events[-1]["categories"]["changed"]["count"])
+
+    def test_mirror_new_metrics(self):
+        test_name = "mirror-new-metrics"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "new", "nomoves": True, "noprompt": True, "nolog": True, "noarchive": True, "metrics_file": os.path.join(test_name, "backupy.prom")}
+        dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, cleanup=False, solution="mirror-new")
+        with open(os.path.join(test_name, "backupy.prom"), "r") as f:
+            lines = f.read().splitlines()
+        cleanupTestDir(test_name)
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+        values = {line.split("{")[0] + "|" + line.split(",")[-1].split("}")[0]: float(line.split(" ")[-1]) for line in lines if not line.startswith("#")}
+        self.assertEqual(values['backupy_run_status|status="completed"'], 1)
+        self.assertEqual(values['backupy_files|op="copy"'], values['backupy_transfer_files|category="source_only"'] + values['backupy_transfer_files|category="changed"'])
+        self.assertIn('backupy_phase_duration_seconds|phase="transfer"', values)
+        self.assertIn('backupy_files|side="source"', values)
+
+    def test_mirror_new_memprofile(self):
+        test_name = "mirror-new-memprofile"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "new", "nomoves": True, "noprompt": True, "nolog": True, "noarchive": True, "memprofile": os.path.join(test_name, "memprofile.txt")}
+        dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, cleanup=False, solution="mirror-new")
+        with open(os.path.join(test_name, "memprofile.txt"), "r") as f:
+            report = f.read()
+        cleanupTestDir(test_name)
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+        for phase in ["### SCAN ###", "### COMPARE ###", "### TRANSFER ###", "### END ###"]:
+            self.assertIn(phase, report)
+        self.assertIn("source.dict_current", report)
+        self.assertIn("transfer_lists.source_only", report)
+        self.assertIn("top allocation sites:", report)
+
+    def test_mirror_new_rsync(self):
+        test_name = "mirror-new-rsync"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "new", "nomoves": True, "noprompt": True, "nolog": True, "noarchive": True, "use_rsync": True}
+        dirA, dirB, dirAsol, dirBsol, compDict = runRsyncTest(test_name, config, solution="mirror-new")
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+
+    def test_mirror_new_rsync_errors(self):
+        test_name = "mirror-new-rsync-errors"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "new", "nomoves": True, "noprompt": True, "nolog": False, "noarchive": True, "use_rsync": True, "backup_time_override": "000000-0000"}
+        runRsyncTest(test_name, dict(config), missing=True, rewrite_log=False, compare=False, cleanup=False)
+        missing_rows = readLogRows(test_name)
+        runRsyncTest(test_name, dict(config), corrupt_first=True, rewrite_log=False, compare=False, cleanup=False)
+        corrupt_rows = readLogRows(test_name)
+        cleanupTestDir(test_name)
+        copies = [r for r in missing_rows if r[0] == "Copy:"]
+        self.assertTrue(copies)
+        self.assertEqual(len([r for r in missing_rows if r[0] == "COPY ERROR"]), len(copies))
+        errors = [r for r in corrupt_rows if r[0] == "COPY ERROR"]
+        self.assertEqual(len(errors), 1)
+        self.assertIn("return code 23", errors[0][-1])
+        # database CRCs are patched into the settings row as fixed width hex
+        for crc in [corrupt_rows[1][5], corrupt_rows[1][7]]:
+            self.assertRegex(crc, "^[0-9A-F]{8}$")
+
+    def test_mirror_new_rsync_events(self):
+        test_name = "mirror-new-rsync-events"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "new", "nomoves": True, "noprompt": True, "nolog": True, "noarchive": True, "use_rsync": True,
+                  "copy_order": "largest", "sync_every_files": 1, "event_stream": os.path.join(test_name, "events.jsonl")}
+        synced = []
+        sync = backupy.utils.FileOps.sync
+        backupy.utils.FileOps.sync = lambda root_paths, file_paths: synced.append(list(file_paths)) or sync(root_paths, file_paths)
+        try:
+            start = time.monotonic()
+            dirA, dirB, dirAsol, dirBsol, compDict = runRsyncTest(test_name, config, delay=0.02, cleanup=False, solution="mirror-new")
+            elapsed = time.monotonic() - start
+        finally:
+            backupy.utils.FileOps.sync = sync
+        with open(os.path.join(test_name, "events.jsonl"), "r") as f:
+            events = [json.loads(line) for line in f]
+        cleanupTestDir(test_name)
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+        copies = [e for e in events if e["event"] == "operation" and e["op"] == "copy"]
+        self.assertGreater(len(copies), 2)
+        # each file is timed on its own instead of from the start of the batch
+        self.assertLess(sum(e["duration"] for e in copies), elapsed)
+        # checkpoints after every file like copies without rsync
+        self.assertGreater(len(synced), 2)
+        self.assertEqual(max(len(file_paths) for file_paths in synced), 1)
+
+    def test_mirror_new_plan(self):
+        test_name = "mirror-new-plan"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "new", "nomoves": True, "noprompt": True, "nolog": True, "noarchive": True, "dry_run": True, "plan_export": os.path.join(test_name, "plan.json")}
+        runTest(test_name, config, rewrite_log=False, compare=False, cleanup=False)
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "new", "nomoves": True, "noprompt": True, "nolog": True, "noarchive": True, "plan_apply": os.path.join(test_name, "plan.json")}
+        dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, rewrite_log=False, setup=False, solution="mirror-new")
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+
+    def test_mirror_new_plan_stale_target(self):
+        test_name = "mirror-new-plan-stale-target"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "new", "nomoves": True, "noprompt": True, "nolog": True, "noarchive": True, "dry_run": True, "plan_export": os.path.join(test_name, "plan.json")}
+        runTest(test_name, config, rewrite_log=False, compare=False, cleanup=False)
+        # a file created on dest after the plan where the plan copies one
+        with open(os.path.join(test_name, "dir B", "file only A.txt"), "w") as f:
+            f.write("created after the plan")
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "new", "nomoves": True, "noprompt": True, "nolog": True, "noarchive": True, "plan_apply": os.path.join(test_name, "plan.json"),
+                  "source": os.path.join(test_name, "dir A"), "dest": os.path.join(test_name, "dir B")}
+        result = backupy.backupman.BackupManager(config).run()
+        with open(os.path.join(test_name, "dir B", "file only A.txt"), "r") as f:
+            contents = f.read()
+        cleanupTestDir(test_name)
+        self.assertEqual(result, 1)
+        self.assertEqual(contents, "created after the plan")
+
     def test_mirror_source(self):
         test_name = "mirror-source"
         config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "source", "nomoves": True, "noprompt": True, "nolog": True, "noarchive": True}
@@ -340,6 +556,492 @@ class TestBackupy(unittest.TestCase):
         self.assertEqual(dirA, dirAsol, str(compDict))
         self.assertEqual(dirB, dirBsol, str(compDict))
 
+    def test_mirror_source_log_history(self):
+        test_name = "mirror-source-log-history"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "source", "nomoves": False, "noprompt": True, "nolog": False, "noarchive": False, "backup_time_override": "000000-0000", "history_index": True}
+        runTest(test_name, config, rewrite_log=False, compare=False, cleanup=False)
+        history = backupy.history.HistoryIndex(os.path.join(test_name, "dir A", ".backupy", "Logs"))
+        new_rows = history.update()
+        archived = history.lookup("file modified newer on A.txt")
+        moved = history.lookup("renamed file A.txt")
+        history.close()
+        status = backupy.history.printHistory("file only A.txt", os.path.join(test_name, "dir A"))
+        cleanupTestDir(test_name)
+        self.assertEqual(new_rows, 0)
+        self.assertEqual(status, 0)
+        self.assertIn(("Move:", "<dest>/.backupy/Archive/000000-0000"), [(r["action"], r["other_root"]) for r in archived])
+        self.assertIn(("Move:", "renamed file B.txt"), [(r["action"], r["file"]) for r in moved])
+
+    def test_mirror_source_log_history_config_dir(self):
+        test_name = "mirror-source-log-history-config-dir"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "source", "nomoves": False, "noprompt": True, "nolog": False, "noarchive": False, "backup_time_override": "000000-0000",
+                  "config_dir": ".bk", "log_dir": ".bk/History"}
+        runTest(test_name, dict(config), rewrite_log=False, compare=False, cleanup=False)
+        writeJson(os.path.join(test_name, "dir A", ".bk", "config.json"), config)
+        argv = sys.argv
+        try:
+            sys.argv = ["backupy", "--history", os.path.join(test_name, "dir A", "file only A.txt"), "--config-dir", ".bk"]
+            status = backupy.cli.main()
+        finally:
+            sys.argv = argv
+        cleanupTestDir(test_name)
+        self.assertEqual(status, 0)
+
+    def test_mirror_source_log_compaction(self):
+        test_name = "mirror-source-log-compaction"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "source", "nomoves": False, "noprompt": True, "nolog": False, "noarchive": False, "backup_time_override": "000000-0000", "log_compression": "xz", "log_retention_days": 30}
+        log_dir = os.path.join(test_name, "dir A", ".backupy", "Logs")
+        setupTestDir(test_name, "tests/test_dir_set0.zip")
+        os.makedirs(log_dir)
+        with open(os.path.join(log_dir, "log-991231-2359.csv"), "w") as f:
+            f.write("### START MIRROR ###\nMove:,<dest>,old.txt,<dest>/.backupy/Trash/991231-2359,old.txt\n")
+        os.utime(os.path.join(log_dir, "log-991231-2359.csv"), (1e9, 1e9))
+        # an uncompressed log left next to its compressed copy
+        with open(os.path.join(log_dir, "log-991231-2358.csv"), "w") as f:
+            f.write("### START MIRROR ###\n")
+        with open(os.path.join(log_dir, "log-991231-2358.csv"), "rb") as f_source, gzip.open(os.path.join(log_dir, "log-991231-2358.csv.gz"), "wb") as f_dest:
+            f_dest.write(f_source.read())
+        for f in ["log-991231-2358.csv", "log-991231-2358.csv.gz"]:
+            os.utime(os.path.join(log_dir, f), (1e9, 1e9))
+        runTest(test_name, config, rewrite_log=False, compare=False, setup=False, cleanup=False)
+        log_files = sorted(os.listdir(log_dir))
+        with zipfile.ZipFile(os.path.join(log_dir, "logs-9912.zip")) as archive:
+            archived = sorted(archive.namelist())
+        index = readJson(os.path.join(log_dir, "logs-index.json"))
+        history = backupy.history.HistoryIndex(log_dir)
+        history.update()
+        old = history.lookup("old.txt")
+        new = history.lookup("file only A.txt")
+        history.close()
+        cleanupTestDir(test_name)
+        self.assertEqual(log_files, ["log-000000-0000.csv.xz", "logs-9912.zip", "logs-index.json"])
+        self.assertEqual(archived, ["log-991231-2358.csv", "log-991231-2359.csv"])
+        self.assertEqual(index, {"log-991231-2358.csv": "logs-9912.zip", "log-991231-2359.csv": "logs-9912.zip"})
+        self.assertEqual([r["other_root"] for r in old], ["<dest>/.backupy/Trash/991231-2359"])
+        self.assertTrue(new)
+
+    def test_mirror_source_log_latency(self):
+        test_name = "mirror-source-log-latency"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "source", "compare_mode": "crc", "nomoves": False, "noprompt": True, "nolog": False, "noarchive": False, "backup_time_override": "000000-0000", "latency_report": 2}
+        runTest(test_name, config, rewrite_log=False, compare=False, cleanup=False)
+        with open(os.path.join(test_name, "dir A", ".backupy", "Logs", "log-000000-0000.csv"), "r", encoding="utf-8") as f:
+            rows = list(csv.reader(f))
+        cleanupTestDir(test_name)
+        report = rows[[r[0] for r in rows].index("### SLOWEST OPERATIONS ###") + 1:]
+        histograms = {r[1]: int(r[2]) for r in report if r[0] == "Histogram:"}
+        slowest = [r for r in report if r[0] == "Slowest:"]
+        self.assertEqual(sorted(histograms), ["copy", "hash", "listdir", "move", "stat"])
+        self.assertEqual(histograms["copy"], 4)
+        self.assertTrue(all(len([r for r in slowest if r[1] == op]) == min(2, histograms[op]) for op in histograms))
+
+    def test_mirror_source_log_snapshots(self):
+        test_name = "mirror-source-log-snapshots"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "source", "nomoves": True, "noprompt": True, "nolog": False, "noarchive": True, "use_snapshots": True}
+        snapshots = os.path.join(test_name, "dir B", ".backupy", "Snapshots")
+        runTest(test_name, dict(config, backup_time_override="000000-0000"), rewrite_log=False, compare=False, cleanup=False)
+        with open(os.path.join(test_name, "dir A", "file only A.txt"), "w") as f:
+            f.write("changed after the first snapshot")
+        runTest(test_name, dict(config, backup_time_override="000000-0001"), rewrite_log=False, compare=False, setup=False, cleanup=False)
+        with open(os.path.join(test_name, "dir A", ".backupy", "Logs", "log-000000-0001.csv"), "r", encoding="utf-8") as f:
+            rows = list(csv.reader(f))
+        inodes = {}
+        for snapshot in ["000000-0000", "000000-0001"]:
+            for f in ["file only A.txt", "subdir/renamed dir A/file1.txt"]:
+                inodes[(snapshot, f)] = os.stat(os.path.join(snapshots, snapshot, f)).st_ino
+        with open(os.path.join(snapshots, "000000-0001", "file only A.txt"), "r") as f:
+            changed = f.read()
+        cleanupTestDir(test_name)
+        self.assertEqual(inodes[("000000-0000", "subdir/renamed dir A/file1.txt")], inodes[("000000-0001", "subdir/renamed dir A/file1.txt")])
+        self.assertNotEqual(inodes[("000000-0000", "file only A.txt")], inodes[("000000-0001", "file only A.txt")])
+        self.assertEqual(changed, "changed after the first snapshot")
+        self.assertEqual([r for r in rows[2:] if any("Snapshots" in c for c in r)], [])
+
+    def test_mirror_source_log_metadata_workers(self):
+        test_name = "mirror-source-log-metadata-workers"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "source", "nomoves": True, "noprompt": True, "nolog": False, "noarchive": True, "backup_time_override": "000000-0000", "metadata_workers": 4}
+        dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, rewrite_log=True, solution="mirror-source-log")
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+
+    def test_mirror_source_log_largest(self):
+        test_name = "mirror-source-log-largest"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "source", "nomoves": True, "noprompt": True, "nolog": False, "noarchive": True, "backup_time_override": "000000-0000", "copy_order": "largest"}
+        dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, rewrite_log=True, solution="mirror-source-log")
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+
+    def test_mirror_source_log_layout(self):
+        test_name = "mirror-source-log-layout"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "source", "nomoves": True, "noprompt": True, "nolog": False, "noarchive": True, "backup_time_override": "000000-0000", "layout_order": "inode"}
+        dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, rewrite_log=True, solution="mirror-source-log")
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+
+    def test_mirror_source_log_atomic(self):
+        test_name = "mirror-source-log-atomic"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "source", "nomoves": True, "noprompt": True, "nolog": False, "noarchive": True, "backup_time_override": "000000-0000", "atomic_copy": True, "sync_every_files": 2}
+        dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, rewrite_log=True, solution="mirror-source-log")
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+
+    def test_mirror_source_log_atomic_xdev(self):
+        test_name = "mirror-source-log-atomic-xdev"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "source", "nomoves": True, "noprompt": True, "nolog": False, "noarchive": True, "backup_time_override": "000000-0000", "atomic_copy": True}
+        # temp files in config_dir are on another file system than the files they replace
+        replace = backupy.utils.FileOps.replace
+        def crossDeviceReplace(source, dest):
+            if "Partial" in source:
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            replace(source, dest)
+        backupy.utils.FileOps.replace = crossDeviceReplace
+        try:
+            dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, rewrite_log=True, solution="mirror-source-log")
+        finally:
+            backupy.utils.FileOps.replace = replace
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+
+    def test_sync_files_fallback(self):
+        test_name = "sync-files-fallback"
+        shutil.rmtree(test_name, ignore_errors=True)
+        os.makedirs(test_name)
+        read_only, broken_link, missing = [os.path.join(test_name, f) for f in ["read only.txt", "broken link", "missing.txt"]]
+        with open(read_only, "w") as f:
+            f.write("read only")
+        os.chmod(read_only, 0o444)
+        os.symlink("missing target", broken_link)
+        # the root does not exist, so syncfs fails and each file is synced instead
+        errors = backupy.utils.syncFiles([os.path.join(test_name, "missing root")], [read_only, broken_link, missing])
+        cleanupTestDir(test_name)
+        self.assertEqual([file_path for file_path, _ in errors], [missing])
+
+    def test_mirror_source_log_journal(self):
+        test_name = "mirror-source-log-journal"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "source", "nomoves": True, "noprompt": True, "nolog": False, "noarchive": True, "backup_time_override": "000000-0000", "journal_checkpoint_ops": 3}
+        dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, rewrite_log=True, solution="mirror-source-log")
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+
+    def test_sync_journal_crash(self):
+        test_name = "sync-journal-crash"
+        config = {"main_mode": "sync", "select_mode": "new", "noprompt": True, "noarchive": True, "sync_propagate_deletions": True, "journal_checkpoint_ops": 1}
+        journal_exists, source, dest, transfer_lists = runCrashTest(test_name, config, "s.txt")
+        source_only, dest_only, changed, moved, source_deleted, dest_deleted = transfer_lists.getLists()
+        self.assertFalse(journal_exists)
+        self.assertEqual(list(source_deleted), ["s.txt"])
+        self.assertEqual(list(dest_only), [])
+        self.assertEqual(list(dest_deleted), [])
+        self.assertIn("c.txt", source.set_modified & dest.set_modified)
+
+    def test_sync_checkpoint_crash(self):
+        test_name = "sync-checkpoint-crash"
+        config = {"main_mode": "sync", "select_mode": "new", "noprompt": True, "noarchive": True, "sync_propagate_deletions": True, "sync_every_files": 1}
+        journal_exists, source, dest, transfer_lists = runCrashTest(test_name, config, "n2.txt")
+        source_only, dest_only, changed, moved, source_deleted, dest_deleted = transfer_lists.getLists()
+        # checkpoints only sync the journal, which is replayed by the next run
+        self.assertTrue(journal_exists)
+        self.assertEqual(list(source_only), ["n2.txt"])
+        self.assertEqual(list(changed), ["c.txt"])
+        self.assertIn("c.txt", source.set_modified & dest.set_modified)
+
+    def test_mirror_dedup(self):
+        test_name = "mirror-dedup"
+        config = {"main_mode": "mirror", "select_mode": "source", "noprompt": True, "nolog": False, "noarchive": True, "use_dedup_store": True}
+        dir_A, dir_B = os.path.join(test_name, "dir A"), os.path.join(test_name, "dir B")
+        objects = os.path.join(dir_B, ".backupy", "Objects")
+        shutil.rmtree(test_name, ignore_errors=True)
+        os.makedirs(dir_A)
+        for f, data in [("x.txt", "same"), ("y.txt", "same"), ("w.txt", "wwww")]:
+            with open(os.path.join(dir_A, f), "w") as fp:
+                fp.write(data)
+            os.utime(os.path.join(dir_A, f), (1e9, 1e9))
+        # an object with the same key as w.txt but different contents
+        w_key = "%X-4-1000000000" % (crc(os.path.join(dir_A, "w.txt")))
+        os.makedirs(os.path.join(objects, w_key[:2]))
+        with open(os.path.join(objects, w_key[:2], w_key), "w") as fp:
+            fp.write("XXXX")
+        config.update({"source": dir_A, "dest": dir_B})
+        backupy.backupman.BackupManager(dict(config, backup_time_override="000000-0001")).run()
+        x_stat, y_stat = os.stat(os.path.join(dir_B, "x.txt")), os.stat(os.path.join(dir_B, "y.txt"))
+        with open(os.path.join(dir_B, "w.txt"), "r") as fp:
+            w_data = fp.read()
+        # objects of x.txt and y.txt are pruned once no file links to them (and the object with the key of w.txt was never linked)
+        os.remove(os.path.join(dir_A, "x.txt"))
+        os.remove(os.path.join(dir_A, "y.txt"))
+        backupy.backupman.BackupManager(dict(config, backup_time_override="000000-0002")).run()
+        object_count = sum(len(f) for _, _, f in os.walk(objects))
+        with open(os.path.join(dir_A, ".backupy", "Logs", "log-000000-0002.csv"), "r", encoding="utf-8") as f:
+            removed = [r[2] for r in csv.reader(f) if r and r[0] == "Remove:"]
+        cleanupTestDir(test_name)
+        self.assertEqual(x_stat.st_ino, y_stat.st_ino)
+        self.assertEqual(x_stat.st_nlink, 3)
+        self.assertEqual(w_data, "wwww")
+        self.assertEqual(object_count, 0)
+        self.assertEqual(sorted(removed), ["x.txt", "y.txt"])
+
+    def test_mirror_new_dedup_nolinks(self):
+        test_name = "mirror-new-dedup-nolinks"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "new", "nomoves": True, "noprompt": True, "nolog": True, "noarchive": True, "use_dedup_store": True}
+        link = backupy.utils.FileOps.link
+        def failingLink(source, dest):
+            raise OSError(1, "Operation not permitted")
+        backupy.utils.FileOps.link = failingLink
+        try:
+            dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, cleanup=False, solution="mirror-new")
+        finally:
+            backupy.utils.FileOps.link = link
+        objects = os.path.exists(os.path.join(test_name, "dir B", ".backupy", "Objects"))
+        cleanupTestDir(test_name)
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+        self.assertFalse(objects)
+
+    def test_mirror_compression(self):
+        test_name = "mirror-compression"
+        config = {"main_mode": "mirror", "select_mode": "source", "noprompt": True, "nolog": False, "noarchive": False, "archive_compression": "gzip", "compression_workers": 1, "backup_time_override": "000000-0001"}
+        dir_A, dir_B = os.path.join(test_name, "dir A"), os.path.join(test_name, "dir B")
+        archive = os.path.join(dir_B, ".backupy", "Archive", "000000-0001")
+        shutil.rmtree(test_name, ignore_errors=True)
+        for d, version in [(dir_A, b"new version"), (dir_B, b"old")]:
+            os.makedirs(d)
+            for f in ["data.csv", "data.csv.gz", "other.txt"]:
+                with open(os.path.join(d, f), "wb") as fp:
+                    fp.write(f.encode() + version)
+        config.update({"source": dir_A, "dest": dir_B})
+        backupy.backupman.BackupManager(config).run()
+        archived = sorted(os.listdir(archive))
+        contents = {}
+        for f in archived:
+            with gzip.open(os.path.join(archive, f), "rb") if f != "data.csv.gz" else open(os.path.join(archive, f), "rb") as fp:
+                contents[f] = fp.read()
+        index = readJson(archive + ".json")
+        cleanupTestDir(test_name)
+        self.assertEqual(archived, ["data.csv.1.gz", "data.csv.gz", "other.txt.gz"])
+        self.assertEqual(contents, {"data.csv.1.gz": b"data.csvold", "data.csv.gz": b"data.csv.gzold", "other.txt.gz": b"other.txtold"})
+        self.assertEqual(sorted(index), ["data.csv", "other.txt"])
+        self.assertEqual(index["data.csv"]["compressed"], "data.csv.1.gz")
+        self.assertEqual(index["other.txt"]["crc"], "%X" % (zlib.crc32(b"other.txtold")))
+
+    def test_mirror_empty_dir_over_files(self):
+        test_name = "mirror-empty-dir-over-files"
+        config = {"main_mode": "mirror", "select_mode": "source", "noprompt": True, "nolog": False, "noarchive": True, "backup_time_override": "000000-0000"}
+        dir_A, dir_B = os.path.join(test_name, "dir A"), os.path.join(test_name, "dir B")
+        shutil.rmtree(test_name, ignore_errors=True)
+        os.makedirs(os.path.join(dir_A, "x"))
+        os.makedirs(os.path.join(dir_B, "x"))
+        with open(os.path.join(dir_B, "x", "a"), "w") as f:
+            f.write("a")
+        config.update({"source": dir_A, "dest": dir_B})
+        backupy.backupman.BackupManager(config).run()
+        dest = sorted(os.listdir(dir_B))
+        dest_x = os.listdir(os.path.join(dir_B, "x")) if os.path.isdir(os.path.join(dir_B, "x")) else None
+        errors = [row for row in readLogRows(test_name) if "ERROR" in row[0]]
+        cleanupTestDir(test_name)
+        self.assertEqual(dest, [".backupy", "x"])
+        self.assertEqual(dest_x, [])
+        self.assertEqual(errors, [])
+
+    def test_token_bucket(self):
+        start = time.monotonic()
+        backupy.ratelimiter.TokenBucket(0).consume(2 ** 40)
+        unlimited = time.monotonic() - start
+        bucket = backupy.ratelimiter.TokenBucket(1000)
+        start = time.monotonic()
+        bucket.consume(1000)
+        burst = time.monotonic() - start
+        bucket.consume(500)
+        limited = time.monotonic() - start
+        self.assertLess(unlimited, 0.1)
+        self.assertLess(burst, 0.1)
+        self.assertGreaterEqual(limited, 0.45)
+
+    def test_mirror_rate_limited(self):
+        test_name = "mirror-rate-limited"
+        config = {"main_mode": "mirror", "select_mode": "source", "noprompt": True, "nolog": True, "noarchive": False, "archive_compression": "gzip",
+                  "limit_write_bps": 2 ** 30, "resume_copy_threshold": 4096, "delta_copy_threshold": 2048, "delta_block_size": 512}
+        dir_A, dir_B = os.path.join(test_name, "dir A"), os.path.join(test_name, "dir B")
+        shutil.rmtree(test_name, ignore_errors=True)
+        files_A = {"n.txt": b"new", "r.bin": bytes(range(256)) * 32, "c.txt": b"changed", "d.bin": bytes(4096)}
+        files_B = {"c.txt": b"old", "d.bin": bytes(2048) + b"x" + bytes(2047)}
+        for d, files in [(dir_A, files_A), (dir_B, files_B)]:
+            os.makedirs(d)
+            for f in files:
+                with open(os.path.join(d, f), "wb") as fp:
+                    fp.write(files[f])
+                if d == dir_B:
+                    os.utime(os.path.join(d, f), (1000000000, 1000000000))
+        config.update({"source": dir_A, "dest": dir_B})
+        # record every file written through the limiter
+        written = []
+        writer_init = backupy.ratelimiter.ThrottledWriter.__init__
+        def recordingInit(writer, f, limiter):
+            written.append(os.path.basename(f.name))
+            writer_init(writer, f, limiter)
+        originals = {attr: getattr(backupy.utils.FileOps, attr) for attr in ["open", "openw", "copy", "copyff"]}
+        backupy.ratelimiter.ThrottledWriter.__init__ = recordingInit
+        try:
+            backupy.backupman.BackupManager(config).run()
+        finally:
+            backupy.ratelimiter.ThrottledWriter.__init__ = writer_init
+        restored = {attr: getattr(backupy.utils.FileOps, attr) for attr in originals}
+        dest = {}
+        for f in files_A:
+            with open(os.path.join(dir_B, f), "rb") as fp:
+                dest[f] = fp.read()
+        archived = os.listdir(os.path.join(dir_B, ".backupy", "Archive"))
+        cleanupTestDir(test_name)
+        self.assertEqual(dest, files_A)
+        self.assertEqual(restored, originals)
+        # copy, delta patch (of a temp file), resumable copy, and compression of the archived c.txt
+        self.assertIn("n.txt", written)
+        self.assertTrue(any(f.endswith(".tmp") and not f.endswith(".gz.tmp") for f in written))
+        self.assertTrue(any(f.endswith(".part") for f in written))
+        self.assertTrue(any(f.endswith(".gz.tmp") for f in written))
+        self.assertEqual(len(archived), 2)
+
+    def test_mirror_resume_partials(self):
+        test_name = "mirror-resume-partials"
+        config = {"main_mode": "mirror", "select_mode": "source", "noprompt": True, "nolog": True, "noarchive": True, "resume_copy_threshold": 4096, "resume_copy_verify": True}
+        dir_A, dir_B = os.path.join(test_name, "dir A"), os.path.join(test_name, "dir B")
+        partial_dir = os.path.join(dir_B, ".backupy", "Partial")
+        shutil.rmtree(test_name, ignore_errors=True)
+        os.makedirs(dir_A)
+        os.makedirs(partial_dir)
+        data = bytes(range(256)) * 32
+        for f in ["r1.bin", "r2.bin"]:
+            with open(os.path.join(dir_A, f), "wb") as fp:
+                fp.write(data)
+        with open(os.path.join(test_name, "keep.bin"), "wb") as fp:
+            fp.write(data)
+        def writePartial(part_name, source, prefix, crc_prefix):
+            # an interrupted copy of source with prefix copied and the CRC of crc_prefix checkpointed
+            with open(os.path.join(partial_dir, part_name), "wb") as fp:
+                fp.write(prefix)
+            stat = os.stat(source) if os.path.exists(source) else os.stat(os.path.join(dir_A, "r1.bin"))
+            writeJson(os.path.join(partial_dir, part_name + ".json"), {"source": source, "size": stat.st_size, "mtime": stat.st_mtime, "offset": len(prefix), "crc": zlib.crc32(crc_prefix)})
+        def partName(f):
+            return "%X.part" % (zlib.crc32(os.fsencode(os.path.join(os.path.abspath(dir_B), f))) & 0xFFFFFFFF)
+        # r1 resumes, r2 fails verification and restarts, the others are stale except keep
+        writePartial(partName("r1.bin"), os.path.abspath(os.path.join(dir_A, "r1.bin")), data[:4096], data[:4096])
+        writePartial(partName("r2.bin"), os.path.abspath(os.path.join(dir_A, "r2.bin")), bytes(4096), data[:4096])
+        writePartial("gone.part", os.path.abspath(os.path.join(dir_A, "gone.bin")), data[:4096], data[:4096])
+        writePartial("keep.part", os.path.abspath(os.path.join(test_name, "keep.bin")), data[:4096], data[:4096])
+        for f in ["orphan.part.json", "interrupted.tmp"]:
+            with open(os.path.join(partial_dir, f), "w") as fp:
+                fp.write("{}")
+        config.update({"source": dir_A, "dest": dir_B})
+        # record where each source file is read from
+        seeks = []
+        class SeekRecorder:
+            def __init__(self, f):
+                self.f = f
+            def seek(self, offset):
+                seeks.append((os.path.basename(self.f.name), offset))
+                return self.f.seek(offset)
+            def __enter__(self):
+                return self
+            def __exit__(self, *args):
+                self.f.close()
+            def __getattr__(self, attr):
+                return getattr(self.f, attr)
+        file_open = backupy.utils.FileOps.open
+        backupy.utils.FileOps.open = lambda path: SeekRecorder(file_open(path))
+        try:
+            backupy.backupman.BackupManager(config).run()
+        finally:
+            backupy.utils.FileOps.open = file_open
+        partials = sorted(os.listdir(partial_dir))
+        dest = []
+        for f in ["r1.bin", "r2.bin"]:
+            with open(os.path.join(dir_B, f), "rb") as fp:
+                dest.append(fp.read())
+        os.remove(os.path.join(test_name, "keep.bin"))
+        with open(os.path.join(dir_A, "new.txt"), "w") as fp:
+            fp.write("new")
+        backupy.backupman.BackupManager(config).run()
+        partial_dir_exists = os.path.exists(partial_dir)
+        cleanupTestDir(test_name)
+        self.assertEqual(sorted(seeks), [("r1.bin", 4096), ("r2.bin", 0)])
+        self.assertEqual(dest, [data, data])
+        self.assertEqual(partials, ["keep.part", "keep.part.json"])
+        self.assertFalse(partial_dir_exists)
+
+    def test_mirror_metadata_workers_interrupted(self):
+        test_name = "mirror-metadata-workers-interrupted"
+        config = {"main_mode": "mirror", "select_mode": "source", "noprompt": True, "nolog": True, "noarchive": True, "metadata_workers": 4}
+        dir_A, dir_B = os.path.join(test_name, "dir A"), os.path.join(test_name, "dir B")
+        shutil.rmtree(test_name, ignore_errors=True)
+        os.makedirs(dir_A)
+        for i in range(400):
+            d = os.path.join(dir_B, "d%s" % (i % 10))
+            os.makedirs(d, exist_ok=True)
+            with open(os.path.join(d, "%s.txt" % i), "w") as f:
+                f.write(str(i))
+        config.update({"source": dir_A, "dest": dir_B})
+        # interrupt the run on the third removal
+        removed = []
+        remove_file = backupy.fileman.FileManager._removeFile
+        def interruptedRemoveFile(fileman, root_path, file_relative_path, result=None):
+            if len(removed) == 2:
+                raise KeyboardInterrupt
+            removed.append(file_relative_path)
+            remove_file(fileman, root_path, file_relative_path, result)
+        backupy.fileman.FileManager._removeFile = interruptedRemoveFile
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                backupy.backupman.BackupManager(config).run()
+        finally:
+            backupy.fileman.FileManager._removeFile = remove_file
+        time.sleep(0.1)
+        remaining = sum(len(files) for _, _, files in os.walk(dir_B))
+        cleanupTestDir(test_name)
+        # only the first window and the one after it could have been started
+        self.assertEqual(len(removed), 2)
+        self.assertGreaterEqual(remaining, 400 - 2 * 4 * 16)
+
+    def test_mirror_delta_archive(self):
+        test_name = "mirror-delta-archive"
+        config = {"main_mode": "mirror", "select_mode": "source", "noprompt": True, "nolog": False, "noarchive": False, "backup_time_override": "000000-0000", "delta_copy_threshold": 1024, "delta_block_size": 512}
+        dir_A, dir_B = os.path.join(test_name, "dir A"), os.path.join(test_name, "dir B")
+        shutil.rmtree(test_name, ignore_errors=True)
+        os.makedirs(dir_A)
+        os.makedirs(dir_B)
+        old, new = bytes(4096), bytes(2048) + b"x" + bytes(2047)
+        for d, data in [(dir_A, new), (dir_B, old)]:
+            with open(os.path.join(d, "big.bin"), "wb") as f:
+                f.write(data)
+        os.utime(os.path.join(dir_B, "big.bin"), (1000000000, 1000000000))
+        os.chmod(os.path.join(dir_B, "big.bin"), 0o444)
+        config.update({"source": dir_A, "dest": dir_B})
+        # a failed patch leaves dest and the archive untouched
+        patch = backupy.utils.FileOps.patch
+        def failingPatch(source, dest, dest_blocks, block_size):
+            with open(dest, "r+b") as f:
+                f.write(b"torn")
+            raise Exception("patch failed")
+        backupy.utils.FileOps.patch = failingPatch
+        try:
+            backupy.backupman.BackupManager(config).run()
+        finally:
+            backupy.utils.FileOps.patch = patch
+        with open(os.path.join(dir_B, "big.bin"), "rb") as f:
+            failed = f.read()
+        failed_archive = os.path.exists(os.path.join(dir_B, ".backupy", "Archive"))
+        failed_partial = os.path.exists(os.path.join(dir_B, ".backupy", "Partial"))
+        backupy.backupman.BackupManager(config).run()
+        with open(os.path.join(dir_B, "big.bin"), "rb") as f:
+            patched = f.read()
+        with open(os.path.join(dir_B, ".backupy", "Archive", "000000-0000", "big.bin"), "rb") as f:
+            archived = f.read()
+        rows = [row[0] for row in readLogRows(test_name) if row[0] in ["Move:", "Delta Copy:", "DELTA COPY ERROR"]]
+        cleanupTestDir(test_name)
+        self.assertEqual(failed, old)
+        self.assertFalse(failed_archive)
+        self.assertFalse(failed_partial)
+        self.assertEqual(patched, new)
+        self.assertEqual(archived, old)
+        self.assertEqual(rows, ["Delta Copy:", "Move:"])
+
     def test_mirror_dest(self):
         test_name = "mirror-dest"
         config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "dest", "nomoves": True, "noprompt": True, "nolog": True, "noarchive": True}
@@ -396,6 +1098,15 @@ class TestBackupy(unittest.TestCase):
         self.assertEqual(dirA, dirAsol, str(compDict))
         self.assertEqual(dirB, dirBsol, str(compDict))
 
+    def test_sync_source_plan(self):
+        test_name = "sync-source-plan"
+        config = {"force_posix_path_sep": True, "main_mode": "sync", "select_mode": "source", "nomoves": True, "sync_propagate_deletions": True, "noprompt": True, "nolog": True, "noarchive": True, "dry_run": True, "plan_export": os.path.join(test_name, "plan.json")}
+        runTest(test_name, config, rewrite_log=False, compare=False, cleanup=False)
+        config = {"force_posix_path_sep": True, "main_mode": "sync", "select_mode": "source", "nomoves": True, "sync_propagate_deletions": True, "noprompt": True, "nolog": True, "noarchive": True, "plan_apply": os.path.join(test_name, "plan.json")}
+        dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, rewrite_log=False, setup=False, solution="sync-source")
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+
     def test_sync_source_log(self):
         test_name = "sync-source-log"
         config = {"force_posix_path_sep": True, "main_mode": "sync", "select_mode": "source", "nomoves": True, "noprompt": True, "nolog": False, "noarchive": True, "backup_time_override": "000000-0000"}
@@ -424,6 +1135,20 @@ class TestBackupy(unittest.TestCase):
         self.assertEqual(dirA, dirAsol, str(compDict))
         self.assertEqual(dirB, dirBsol, str(compDict))
 
+    def test_mirror_source_delta(self):
+        test_name = "mirror-source-delta"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "source", "nomoves": True, "noprompt": True, "nolog": True, "noarchive": True, "delta_copy_threshold": 1, "delta_block_size": 4}
+        dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, solution="mirror-source")
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+
+    def test_mirror_new_archive_delta(self):
+        test_name = "mirror-new-archive-delta"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "new", "nomoves": True, "noprompt": True, "nolog": True, "noarchive": False, "archive_dir": ".backupy", "config_dir": ".backupy", "log_dir": ".backupy", "trash_dir": ".backupy/Deleted", "backup_time_override": "000000-0000", "delta_copy_threshold": 1, "delta_block_size": 4}
+        dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, solution="mirror-new-archive")
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+
     def test_backup_new_moved(self):
         test_name = "backup-new-moved"
         config = {"force_posix_path_sep": True, "main_mode": "backup", "select_mode": "new", "nomoves": False, "noprompt": True, "nolog": True, "noarchive": True}
@@ -445,6 +1170,13 @@ class TestBackupy(unittest.TestCase):
         self.assertEqual(dirA, dirAsol, str(compDict))
         self.assertEqual(dirB, dirBsol, str(compDict))
 
+    def test_mirror_new_moved_archive_metadata_workers(self):
+        test_name = "mirror-new-moved-archive-metadata-workers"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "new", "nomoves": False, "noprompt": True, "nolog": True, "noarchive": False, "archive_dir": ".backupy", "config_dir": ".backupy", "log_dir": ".backupy", "trash_dir": ".backupy/Deleted", "backup_time_override": "000000-0000", "metadata_workers": 4}
+        dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, solution="mirror-new-moved-archive")
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+
     def test_mirror_new_moved_archive(self):
         test_name = "mirror-new-moved-archive"
         config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "new", "nomoves": False, "noprompt": True, "nolog": True, "noarchive": False, "archive_dir": ".backupy", "config_dir": ".backupy", "log_dir": ".backupy", "trash_dir": ".backupy/Deleted", "backup_time_override": "000000-0000"}
@@ -663,6 +1395,13 @@ class TestBackupy(unittest.TestCase):
         self.assertEqual(dirA, dirAsol, str(compDict))
         self.assertEqual(dirB, dirBsol, str(compDict))
 
+    def test_mirror_source_crc_layout_set3(self):
+        test_name = "mirror-source-crc-layout-set3"
+        config = {"force_posix_path_sep": True, "main_mode": "mirror", "select_mode": "source", "compare_mode": "crc", "noprompt": True, "backup_time_override": "000000-0000", "layout_order": "extent"}
+        dirA, dirB, dirAsol, dirBsol, compDict = runTest(test_name, config, rewrite_log=True, set=3, solution="mirror-source-crc-set3")
+        self.assertEqual(dirA, dirAsol, str(compDict))
+        self.assertEqual(dirB, dirBsol, str(compDict))
+
     def test_sync_deleted_set0(self):
         test_name = "sync-deleted-log-set0"
         config = {"force_posix_path_sep": True, "main_mode": "sync", "select_mode": "new", "noprompt": True, "source_unique_id": "sourceid", "dest_unique_id": "destid", "sync_propagate_deletions": True, "write_database_x2": True, "backup_time_override": "000000-0000"}